@@ -1,30 +1,51 @@
+import hashlib
+import os
+import time
+
 import pandas as pd
 import matplotlib.pyplot as plt
-from dash import Dash, dcc, html, dash_table, Input, Output
+from flask import Response, g, jsonify, request
+from dash import Dash, DiskcacheManager, dcc, html, dash_table, no_update, Input, Output, State
 
 import src.visualization as viz
 import src.config as config
+import src.loader as loader
+import src.artifacts as artifacts
+import src.cache as cache
+import src.coverage_matrix as coverage_matrix
+import src.jobs as jobs
+import src.metrics as metrics
+import src.search as search
+import src.table_query as table_query
 
-N_MAX_PARENTS = 1
-
-# List of available corpora
-ls_projects = ["DT4H", "BARITONE", "CHAGAS"]
-ls_corpora = ["total", "distemist", "symptemist", "medprocner", "pharmaconer", "cardioccc_temu", "cardioccc_deepspanorm"]
-ls_possible_parents = range(N_MAX_PARENTS + 1)
+ls_projects = config.ls_projects
+ls_corpora = config.ls_corpora
+ls_possible_parents = config.ls_possible_parents
 d_variables_list = {"DT4H": "https://docs.google.com/spreadsheets/d/1GM17jnZop0eHSYaWKccVhp4pdbX58IEuSLXsiYg4GUQ/edit?usp=sharing",
                     "CHAGAS": "https://docs.google.com/spreadsheets/d/1YDBJ-vSYBcZNSIaoF2UFPE_BJgcJXQ4eXrFEiwAr50k/edit?gid=0#gid=0",
                     "BARITONE": "https://docs.google.com/spreadsheets/d/1lVYgvQz9WSmaXmXKL9poNxijRevT5Tv-/edit?gid=93625814#gid=93625814"}
 
+# Reports that are not ready are computed by background callbacks in worker processes, queued in a disk cache
+background_callback_manager = DiskcacheManager(jobs.BACKGROUND_CACHE)
+
 # Initialize the Dash app
 app = Dash(__name__,
            url_base_pathname='/coverage/',
+           background_callback_manager=background_callback_manager,
+           # The table callbacks target a DataTable created by update_content
+           suppress_callback_exceptions=True,
 )
 
+# Flask server used by WSGI servers, see wsgi.py
+server = app.server
+
 # Define the layout of the app
 app.layout = html.Div(children=[
             config.TOP_DIV,
             
             html.Div(id='variables-link-container'),
+            html.A("Download the coverage matrix of all projects and corpora (CSV)",
+                   href="/coverage/api/coverage-matrix?format=csv", style={'fontSize': '16px'}),
             
             html.P("Select project", style=config.PAR_STYLE),
             dcc.Dropdown(
@@ -34,14 +55,14 @@ app.layout = html.Div(children=[
                 multi=False
             ),
             
-            html.P("Select the corpus in which you want to check the variables (total combines symptoms, diseases, drugs and procedures)",
+            html.P("Select the corpora in which you want to check the variables (total combines symptoms, diseases, drugs and procedures)",
                    style=config.PAR_STYLE),
 
             dcc.Dropdown(
                 id='corpora-dropdown',
                 options=[{'label': corpus, 'value': corpus} for corpus in ls_corpora],
-                value="total",  # Default selected values
-                multi=False
+                value=["total"],  # Default selected values
+                multi=True
             ),
 
             html.P("By default, annotations can be more precise than the variables, so we can compare the variables with concept first N parents.\n Select the number of parents to consider for the comparison",
@@ -49,20 +70,34 @@ app.layout = html.Div(children=[
             html.P(),
             dcc.Dropdown(
                 id='n_parents-dropdown',
-                options=[{'label': f"{n_parents} parents", 'value': n_parents} for n_parents in ls_possible_parents],
+                options=[{'label': "all parents" if n_parents == config.ALL_PARENTS else f"{n_parents} parents", 'value': n_parents}
+                         for n_parents in ls_possible_parents],
                 value=0,  # Default selected values
                 multi=False
             ),
 
 
-            # Wrapping the output components in dcc.Loading
+            # Wrapping the output components in dcc.Loading, the spinner is shown while they are computed
+            # and the progress messages of the background job are displayed next to it
             dcc.Loading(
                 id="loading-1",
                 type="circle",
+                target_components={'graphs-container': 'children', 'table-container': 'children'},
                 children=[
+                    html.Div(id='progress-container', style={"display": "none"}),
                     html.Div(id='graphs-container'),
                     html.Div(id='table-container')
-                ])
+                ]),
+            # Cache key of the report frame shown in the table, and selection of the report computed
+            # in the background when it is not ready
+            dcc.Store(id='table-key'),
+            dcc.Store(id='report-job'),
+
+            html.P("Search the variables (names, terms and translations) and the corpus mentions, e.g. to find the mentions of a variable without matches",
+                   style=config.PAR_STYLE),
+            dcc.Input(id='search-input', type='search', debounce=True, placeholder="insuficiencia cardiaca",
+                      style={'width': '50%'}),
+            html.Div(id='search-container'),
         ])
 
 @app.callback(
@@ -80,53 +115,313 @@ def update_variables_link(selected_project):
     return html.A("Variables List", href=project_url, style={'color': 'blue', 'fontSize': '20px'})
 
 
-# Callback to update the graphs and table based on selected corpora
-@app.callback(
-    [Output('graphs-container', 'children'),
-     Output('table-container', 'children')],
-    [Input('project-dropdown', 'value'),
-     Input('corpora-dropdown', 'value'),
-     Input('n_parents-dropdown', 'value')]
-)
-def update_content(selected_project, selected_corpora, selected_n_parents):
-    import os
+def report_selection(selected_project, selected_corpora, selected_n_parents):
+    """
+    Warning message, available corpora and job key of a selection, or (components, None, None)
+    with the components to show when there is nothing to compute.
+    """
     if (not selected_project):
-        return html.Div(), html.Div()
-    elif (not os.path.exists(f"data/variables/{selected_project}/processed/variables.tsv")):
+        return (html.Div(), html.Div(), None), None, None
+    elif (not os.path.exists(loader.variables_path(selected_project))):
         warning_message = html.Div(
             "Warning: The required variables file is missing.",
             style={"color": "red", "fontWeight": "bold"}
         )
-        return warning_message, html.Div() 
+        return (warning_message, html.Div(), None), None, None
 
     if not selected_corpora:
         # Return empty components if no corpora are selected
-        return html.Div(), html.Div()
-        
-    # Generate report data and figures based on the selected corpora
-    df_out, ls_figures = viz.generate_report_table(selected_project, selected_corpora, n_parents=selected_n_parents)
+        return (html.Div(), html.Div(), None), None, None
+    selected_corpora = selected_corpora if isinstance(selected_corpora, list) else [selected_corpora]
+
+    # Corpora without their corpus or parents data are left out of the report
+    ls_available = [corpus for corpus in selected_corpora
+                    if all(os.path.exists(path) for path in loader.report_inputs(selected_project, corpus, selected_n_parents))]
+    ls_missing = [corpus for corpus in selected_corpora if corpus not in ls_available]
+    warning_message = html.Div(
+        f"Warning: The corpus or parents data for this selection is missing ({', '.join(ls_missing)}).",
+        style={"color": "red", "fontWeight": "bold"}
+    ) if ls_missing else html.Div()
+    if not ls_available:
+        return (warning_message, html.Div(), None), None, None
+
+    # Identical requests running at the same time share a single computation
+    key = ("report_frame", tuple(ls_available)) + tuple(viz.report_key(selected_project, corpus, selected_n_parents)
+                                                        for corpus in ls_available)
+    return warning_message, ls_available, key
+
+
+def render_report(warning_message, key, table, ls_figures):
+    """Graphs, table and table key components of a report table (frame or records) and its figures."""
+    # The table is paged, filtered and sorted on the server from this copy of the report frame or records
+    table_key = hashlib.sha1(repr(key).encode()).hexdigest()
+    jobs.BACKGROUND_CACHE.set(("table", table_key), table)
+    if isinstance(table, dict):
+        columns = [{"name": col, "id": col, "type": col_type} for col, col_type in zip(table["columns"], table["types"])]
+    else:
+        columns = [{"name": i, "id": i, "type": "numeric" if pd.api.types.is_numeric_dtype(table[i]) else "text"}
+                   for i in table.columns]
     
     # Create the graph components
-    graphs = [dcc.Graph(figure=fig) for fig in ls_figures]
+    graphs = [warning_message] + [dcc.Graph(figure=fig) for fig in ls_figures]
     
-    # Create the table component
+    # Create the table component, its rows are sent by update_table
     data_table = dash_table.DataTable(
         id='datatable-interactivity',
-        columns=[{"name": i, "id": i} for i in df_out.columns],
-        data=df_out.to_dict('records'),
-        filter_action="native",
-        sort_action="native",
+        columns=columns,
+        data=[],
+        filter_action="custom",
+        filter_query="",
+        sort_action="custom",
         sort_mode="multi",
+        sort_by=[],
         column_selectable="single",
         row_selectable="multi",
         selected_columns=[], 
         selected_rows=[],
-        page_action="native",
+        page_action="custom",
         page_current=0,
         page_size=20,
+        page_count=1,
     )
     
-    return graphs, data_table
+    return graphs, data_table, table_key
+
+
+# Callback to update the graphs and table based on selected corpora. Reports that are ready (an
+# artifact, the result cache of this process or a finished job) are served right away, the rest
+# are handed to compute_content through the report-job store
+@app.callback(
+    [Output('graphs-container', 'children'),
+     Output('table-container', 'children'),
+     Output('table-key', 'data'),
+     Output('report-job', 'data')],
+    [Input('project-dropdown', 'value'),
+     Input('corpora-dropdown', 'value'),
+     Input('n_parents-dropdown', 'value')]
+)
+def update_content(selected_project, selected_corpora, selected_n_parents):
+    warning_message, ls_available, key = report_selection(selected_project, selected_corpora, selected_n_parents)
+    if key is None:
+        # Nothing to compute, the first item holds the components to show
+        return *warning_message, None
+
+    # Serve the view composed from the precomputed artifacts of the corpora if they are up to
+    # date, its table is then paged from the records
+    view = artifacts.load_view(selected_project, ls_available, selected_n_parents)
+    if view is not None:
+        return *render_report(warning_message, key, *view), None
+
+    result = jobs.get_result(key)
+    if result is None:
+        result = viz.generate_report_table(selected_project, ls_available, n_parents=selected_n_parents, cached_only=True)
+    if result is not None:
+        df_out, ls_figures = result
+        return *render_report(warning_message, key, df_out, ls_figures), None
+
+    # The request time makes every request a new value of the store, so that the job also runs
+    # again for the selection it already holds
+    job = {"project": selected_project, "corpora": selected_corpora, "n_parents": selected_n_parents,
+           "requested": time.time()}
+    return warning_message, html.Div(), None, job
+
+
+# Reports that are not ready are computed by background callbacks in worker processes
+@app.callback(
+    [Output('graphs-container', 'children', allow_duplicate=True),
+     Output('table-container', 'children', allow_duplicate=True),
+     Output('table-key', 'data', allow_duplicate=True)],
+    [Input('report-job', 'data')],
+    background=True,
+    progress=Output('progress-container', 'children'),
+    running=[(Output('progress-container', 'style'), {"display": "block", "color": "gray"}, {"display": "none"})],
+    # A job is dropped when the selection changes before it is done
+    cancel=[Input('project-dropdown', 'value'), Input('corpora-dropdown', 'value'), Input('n_parents-dropdown', 'value')],
+    prevent_initial_call=True,
+)
+def compute_content(set_progress, job):
+    if not job:
+        return no_update, no_update, no_update
+    selected_project, selected_n_parents = job["project"], job["n_parents"]
+    warning_message, ls_available, key = report_selection(selected_project, job["corpora"], selected_n_parents)
+    if key is None:
+        # Nothing to compute, the first item holds the components to show
+        return warning_message
+
+    def compute_report():
+        with metrics.profile(f"report_{selected_project}_{'-'.join(ls_available)}_{selected_n_parents}"):
+            df_out, ls_figures = viz.generate_report_table(selected_project, ls_available, n_parents=selected_n_parents,
+                                                           progress=set_progress)
+            # Figures are cached as plain dicts, which load much faster than plotly figure objects
+            with metrics.span("serialization"):
+                return df_out, [fig.to_dict() for fig in ls_figures]
+
+    try:
+        df_out, ls_figures = jobs.compute_once(key, compute_report,
+                                               on_wait=lambda: set_progress("Waiting for the same report requested by another user"))
+        set_progress("Rendering the report")
+        return render_report(warning_message, key, df_out, ls_figures)
+    finally:
+        # The job process exits without running the atexit flush of the metrics
+        metrics.flush()
+
+
+@app.callback(
+    [Output('datatable-interactivity', 'data'),
+     Output('datatable-interactivity', 'page_count')],
+    [Input('datatable-interactivity', 'page_current'),
+     Input('datatable-interactivity', 'page_size'),
+     Input('datatable-interactivity', 'sort_by'),
+     Input('datatable-interactivity', 'filter_query')],
+    [State('table-key', 'data')]
+)
+def update_table(page_current, page_size, sort_by, filter_query, table_key):
+    table = jobs.BACKGROUND_CACHE.get(("table", table_key))
+    if table is None:
+        return [], 1
+    with metrics.span("table_query"):
+        try:
+            if isinstance(table, dict):
+                numeric_columns = {col for col, col_type in zip(table["columns"], table["types"]) if col_type == "numeric"}
+                return table_query.query_records(table["data"], filter_query, sort_by, page_current, page_size,
+                                                 numeric_columns=numeric_columns)
+            return table_query.query_page(table, filter_query, sort_by, page_current, page_size)
+        except ValueError:
+            # A filter that cannot be applied shows no rows rather than every row
+            return [], 1
+
+
+@app.callback(
+    Output('search-container', 'children'),
+    [Input('search-input', 'value'),
+     Input('project-dropdown', 'value'),
+     Input('corpora-dropdown', 'value')]
+)
+def update_search(query, selected_project, selected_corpora):
+    if not query or not query.strip():
+        return html.Div()
+    selected_corpora = selected_corpora if isinstance(selected_corpora, list) else [selected_corpora]
+
+    with metrics.span("search"):
+        coverage_search = search.load_search()
+        df_variables = coverage_search.search_variables(query, limit=10, project=selected_project or None)
+        df_mentions = coverage_search.search_spans(query, limit=20)
+        df_mentions = df_mentions[df_mentions["corpus"].isin(selected_corpora)] if selected_corpora else df_mentions
+
+    def results_table(df):
+        return dash_table.DataTable(columns=[{"name": i, "id": i} for i in df.columns], data=df.to_dict('records'),
+                                    sort_action="native", page_size=10)
+
+    return html.Div([html.P("Variables", style=config.PAR_STYLE), results_table(df_variables),
+                     html.P("Corpus mentions", style=config.PAR_STYLE), results_table(df_mentions)])
+
+
+@server.route('/coverage/api/search')
+def search_endpoint():
+    """
+    Variables and corpus mentions matching ?q=, as JSON. The variables can be restricted to a
+    project and the mentions to a corpus, e.g. ?q=hipertension&project=DT4H&corpus=distemist.
+    """
+    query = request.args.get("q", "")
+    if not query.strip():
+        return Response("q is required", status=400, mimetype="text/plain")
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return Response("limit must be an integer", status=400, mimetype="text/plain")
+    if limit <= 0:
+        return Response("limit must be a positive integer", status=400, mimetype="text/plain")
+
+    with metrics.span("search"):
+        coverage_search = search.load_search()
+        df_variables = coverage_search.search_variables(query, limit=limit, project=request.args.get("project"))
+        df_mentions = coverage_search.search_spans(query, limit=limit, corpus=request.args.get("corpus"))
+    return jsonify({"variables": df_variables.to_dict("records"), "mentions": df_mentions.to_dict("records")})
+
+
+@server.route('/coverage/api/candidates')
+def candidates_endpoint():
+    """
+    Candidate mentions of a corpus for the variables of a project without any match, as JSON
+    records, e.g. ?project=DT4H&corpus=total&parents=1&ids=DT4H-CV4&limit=5. Without ids,
+    every unmatched variable of the project is searched.
+    """
+    project, corpus = request.args.get("project"), request.args.get("corpus", "total")
+    if project not in ls_projects or corpus not in ls_corpora:
+        return Response("project and corpus must be one of the configured projects and corpora",
+                        status=400, mimetype="text/plain")
+    try:
+        n_parents = int(request.args.get("parents", 0))
+        limit = int(request.args.get("limit", 5))
+    except ValueError:
+        return Response("parents and limit must be integers", status=400, mimetype="text/plain")
+    if limit <= 0:
+        return Response("limit must be a positive integer", status=400, mimetype="text/plain")
+    if not all(os.path.exists(path) for path in loader.report_inputs(project, corpus, n_parents)):
+        return Response("The corpus or parents data for this selection is missing", status=404, mimetype="text/plain")
+    ids = request.args.get("ids")
+
+    with metrics.span("search"):
+        df_candidates = search.load_search().candidates(project, corpus, n_parents,
+                                                        ids=ids.split(",") if ids else None, limit=limit)
+    return Response(df_candidates.to_json(orient="records"), mimetype="application/json")
+
+
+@server.route('/coverage/api/coverage-matrix')
+def coverage_matrix_endpoint():
+    """
+    Mention counts of every variable x corpus x number of parents, as JSON records or CSV
+    (?format=csv). The projects, corpora and parents can be restricted with comma separated
+    lists, e.g. ?projects=DT4H&parents=0,1. With ?descendants=1 the counts are the mentions
+    in the subtree of each variable.
+    """
+    def arg_list(name, default, cast=str):
+        value = request.args.get(name)
+        return list(dict.fromkeys(cast(item) for item in value.split(",") if item)) if value else list(default)
+
+    try:
+        projects = arg_list("projects", ls_projects)
+        corpora = arg_list("corpora", ls_corpora)
+        levels = arg_list("parents", ls_possible_parents, cast=int)
+    except ValueError:
+        return Response("parents must be a comma separated list of integers", status=400, mimetype="text/plain")
+    unknown = [project for project in projects if project not in ls_projects] + \
+        [corpus for corpus in corpora if corpus not in ls_corpora] + \
+        [str(n_parents) for n_parents in levels if n_parents not in ls_possible_parents]
+    if unknown:
+        return Response(f"Unknown projects, corpora or parents: {', '.join(unknown)}", status=400, mimetype="text/plain")
+
+    descendants = request.args.get("descendants") == "1"
+
+    key = ("coverage_matrix", tuple(projects), tuple(corpora), tuple(levels), descendants) + \
+        tuple(cache.file_hash(path) for path in coverage_matrix.matrix_inputs(projects, corpora, levels))
+    df_matrix = jobs.run_once(key, lambda: coverage_matrix.compute_coverage_matrix(projects, corpora, levels,
+                                                                                   descendants=descendants))
+
+    if request.args.get("format") == "csv":
+        return Response(df_matrix.to_csv(index=False), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=coverage_matrix.csv"})
+    return Response(df_matrix.to_json(orient="records"), mimetype="application/json")
+
+
+@server.route('/coverage/metrics')
+def metrics_endpoint():
+    """Stage timings and cache hit ratios in the Prometheus text format."""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@server.before_request
+def start_request_profile():
+    # Opt-in per request, only when a profiles folder is configured
+    if request.headers.get("X-Coverage-Profile") == "1" or request.args.get("profile") == "1":
+        g.profiler = metrics.start_profile()
+
+
+@server.after_request
+def stop_request_profile(response):
+    if g.get("profiler") is not None:
+        metrics.stop_profile(g.profiler, request.path)
+    return response
 
 if __name__ == '__main__':
     import argparse
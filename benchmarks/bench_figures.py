@@ -0,0 +1,56 @@
+"""
+Compare the size and build time of the report figures built with plotly express and in
+light mode (src.config.LIGHT_FIGURES) on the processed corpora.
+
+    python benchmarks/bench_figures.py --project DT4H --corpora distemist total --output bench_figures.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.append(os.getcwd())
+
+import src.visualization as viz
+
+FIGURE_NAMES = ["semantic_tags", "pies", "semantic_rel_bars", "span_bars"]
+
+
+def run(project, corpus, n_parents, repeat):
+    df_code_ovr, _ = viz.report_corpus(project, corpus, n_parents, show=False)
+    results = []
+    for light in (False, True):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            output = viz.plot_code_distribution(df_code_ovr, corpus=corpus, show=False, light=light)
+        build_seconds = (time.perf_counter() - start) / repeat
+
+        figures = []
+        for name, fig in zip(FIGURE_NAMES, output[1:]):
+            start = time.perf_counter()
+            fig_json = fig.to_json()
+            figures.append({"figure": name, "traces": len(fig.data), "bytes": len(fig_json),
+                            "to_json_seconds": round(time.perf_counter() - start, 4)})
+        results.append({"corpus": corpus, "n_parents": n_parents, "mode": "light" if light else "express",
+                        "build_seconds": round(build_seconds, 3),
+                        "total_bytes": sum(fig["bytes"] for fig in figures), "figures": figures})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", default="DT4H")
+    parser.add_argument("--corpora", nargs="+", default=["distemist", "total"])
+    parser.add_argument("--parents", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Builds averaged per mode")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    report = {"project": args.project,
+              "results": [result for corpus in args.corpora
+                          for result in run(args.project, corpus, args.parents, args.repeat)]}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
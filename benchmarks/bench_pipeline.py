@@ -0,0 +1,181 @@
+"""
+Time and peak memory of the stages of the coverage pipeline, on the processed corpora and on
+copies scaled to more mentions or a longer variables list, plus the SnomedCT parents queries
+on a synthetic RF2 file. Each stage runs in its own process after loading its inputs, so the
+peak RSS increase is the memory used by the stage. Nothing but the repository data is needed.
+
+    python benchmarks/bench_pipeline.py --scales 1 10 100 --output bench_pipeline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.getcwd())
+
+from benchmarks.synthetic import write_scaled_corpus, write_synthetic_rf2, write_synthetic_variables
+
+STAGES = ["read_csv", "read_corpus_file", "load_counts", "process_composites", "generate_df_codes_0", "generate_df_codes_1",
+          "plot_code_distribution", "report_corpus", "generate_report_table", "snomed_load", "snomed_get_parents"]
+DATA_STAGES = STAGES[:-2]
+
+
+def _setup(stage, case):
+    """Load the inputs of a stage and return a function running it."""
+    # Caches on disk would let a stage skip its work
+    os.environ.pop("COVERAGE_RESULT_CACHE_DIR", None)
+    import pandas as pd
+    import src.loader as loader
+    import src.visualization as viz
+    from src.preprocessing import generate_df_codes, process_composites
+    from src.ontology.SnomedCT import SnomedCT
+
+    if stage.startswith("snomed"):
+        if stage == "snomed_load":
+            return lambda: SnomedCT(file_name_rel=case["rf2"])
+        sct = SnomedCT(file_name_rel=case["rf2"])
+        codes = random.Random(0).sample(case["rf2_codes"], min(case["queries"], len(case["rf2_codes"])))
+        return lambda: [sct.get_parents(code, levels=3) for code in codes]
+
+    loader.DATA_FOLDER = case["data_folder"]
+    loader.VARIABLES_FOLDER = case["variables_folder"]
+    corpus_path = os.path.join(case["data_folder"], f"{case['corpus']}.tsv")
+    parents_path = os.path.join(case["data_folder"], "1_parents", f"{case['corpus']}.tsv")
+
+    if stage == "read_csv":
+        return lambda: pd.read_csv(corpus_path, sep='\t', dtype={'code': str})
+    if stage == "read_corpus_file":
+        return lambda: loader.read_corpus_file(corpus_path)
+    if stage == "load_counts":
+        return lambda: loader.load_counts(case["corpus"])
+    if stage == "report_corpus":
+        return lambda: viz.report_corpus(case["project"], case["corpus"], n_parents=1, show=False)
+    if stage == "generate_report_table":
+        return lambda: viz.generate_report_table(case["project"], case["report_corpora"], n_parents=1)
+
+    df_vars = pd.read_csv(loader.variables_path(case["project"]), sep='\t', dtype={'code': str})
+    if stage == "generate_df_codes_1":
+        df_data = loader.read_corpus_file(parents_path)
+        return lambda: generate_df_codes(df_data, df_vars, n_parents=1)
+
+    df_data = loader.read_corpus_file(corpus_path)
+    if stage == "process_composites":
+        return lambda: process_composites(df_data, df_vars)
+    if stage == "generate_df_codes_0":
+        return lambda: generate_df_codes(df_data, df_vars, n_parents=0)
+
+    df_code_ovr = generate_df_codes(df_data, df_vars, n_parents=0)
+    return lambda: viz.plot_code_distribution(df_code_ovr, corpus=case["corpus"], show=False)
+
+
+def _rss_mb(field):
+    """VmRSS or VmHWM (peak) of this process in MB, from /proc/self/status."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+
+
+def _run_stage(stage, case, queue):
+    try:
+        run_fn = _setup(stage, case)
+        # Reset the peak RSS to the current RSS (Linux >= 4.0), ru_maxrss would include the
+        # memory of the parent process before the exec
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        rss_before = _rss_mb("VmRSS")
+        start = time.perf_counter()
+        run_fn()
+        elapsed = time.perf_counter() - start
+        peak_rss = _rss_mb("VmHWM")
+        queue.put({"seconds": round(elapsed, 3),
+                   "peak_rss_mb": round(peak_rss, 1),
+                   "peak_rss_increase_mb": round(peak_rss - rss_before, 1)})
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def run(stage, case):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(stage, case, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def prepare_data(tmp_dir, args, scale, n_variables):
+    """Copy (or scale) the corpora and variables used by a case into tmp_dir."""
+    data_folder = os.path.join(tmp_dir, "processed")
+    variables_folder = os.path.join(tmp_dir, "variables")
+    os.makedirs(os.path.join(data_folder, "1_parents"), exist_ok=True)
+
+    for corpus in sorted(set(args.report_corpora) | {args.corpus}):
+        for sub_folder in ["", "1_parents"]:
+            src_path = os.path.join(args.data_folder, sub_folder, f"{corpus}.tsv")
+            out_path = os.path.join(data_folder, sub_folder, f"{corpus}.tsv")
+            if scale == 1:
+                shutil.copy(src_path, out_path)
+            else:
+                write_scaled_corpus(src_path, out_path, scale)
+
+    out_path = os.path.join(variables_folder, args.project, "processed", "variables.tsv")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if n_variables:
+        import pandas as pd
+        codes = pd.read_csv(os.path.join(args.data_folder, f"{args.corpus}.tsv"), sep='\t', dtype={'code': str})["code"]
+        write_synthetic_variables(out_path, codes, n_variables)
+    else:
+        shutil.copy(os.path.join(args.variables_folder, args.project, "processed", "variables.tsv"), out_path)
+
+    return {"data_folder": data_folder, "variables_folder": variables_folder, "project": args.project,
+            "corpus": args.corpus, "report_corpora": args.report_corpora}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", default="DT4H")
+    parser.add_argument("--corpus", default="total", help="Corpus of the single corpus stages")
+    parser.add_argument("--report-corpora", nargs="+", default=["distemist", "medprocner", "pharmaconer", "symptemist"],
+                        help="Corpora of the generate_report_table stage")
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100], help="Mention scale factors")
+    parser.add_argument("--variables", nargs="*", type=int, default=[5000],
+                        help="Sizes of synthetic variables lists, run on the unscaled corpora")
+    parser.add_argument("--concepts", type=int, default=100000, help="Concepts in the synthetic RF2 file")
+    parser.add_argument("--queries", type=int, default=10000, help="get_parents calls of the snomed_get_parents stage")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--data-folder", default="data/processed")
+    parser.add_argument("--variables-folder", default="data/variables")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    ls_stages = [stage for stage in args.stages if stage in DATA_STAGES]
+    ls_cases = [(scale, 0) for scale in args.scales] + [(1, n_variables) for n_variables in args.variables]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale, n_variables in (ls_cases if ls_stages else []):
+            case_dir = os.path.join(tmp_dir, f"x{scale}_{n_variables}")
+            case = prepare_data(case_dir, args, scale, n_variables)
+            for stage in ls_stages:
+                result = {"stage": stage, "scale": scale, "variables": n_variables or "project", **run(stage, case)}
+                print(json.dumps(result))
+                results.append(result)
+            shutil.rmtree(case_dir)
+
+        if any(stage.startswith("snomed") for stage in args.stages):
+            rf2_path = os.path.join(tmp_dir, "sct2_Relationship_Full_SYNTH.txt")
+            case = {"rf2": rf2_path, "rf2_codes": write_synthetic_rf2(rf2_path, args.concepts), "queries": args.queries}
+            for stage in [stage for stage in args.stages if stage.startswith("snomed")]:
+                result = {"stage": stage, "concepts": args.concepts, **run(stage, case)}
+                print(json.dumps(result))
+                results.append(result)
+
+    report = {"project": args.project, "corpus": args.corpus, "cpu_count": os.cpu_count(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,70 @@
+"""
+Compare the streaming SnomedCT loader with the original line-by-line loader on a synthetic
+RF2 relationship file. Each loader runs in its own process so that the reported peak RSS
+is not shared between them. The legacy loader needs networkx and tqdm installed.
+
+    python benchmarks/bench_snomed_loader.py --concepts 200000 --output bench_snomed.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+sys.path.append(os.getcwd())
+
+from benchmarks.synthetic import write_synthetic_rf2
+
+
+def _run_loader(name, path, queue):
+    if name == "legacy":
+        from benchmarks.legacy_snomed import LegacySnomedCT as Loader
+    else:
+        from src.ontology.SnomedCT import SnomedCT as Loader
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    Loader(file_name_rel=path)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({"loader": name, "seconds": round(elapsed, 3),
+               "peak_rss_mb": round(peak_rss / 1024, 1),
+               "peak_rss_increase_mb": round((peak_rss - rss_before) / 1024, 1)})
+
+
+def run(path, loaders):
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for name in loaders:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_loader, args=(name, path, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concepts", type=int, default=100000, help="Concepts in the synthetic RF2 file")
+    parser.add_argument("--rf2", help="Use an existing relationship file instead of a synthetic one")
+    parser.add_argument("--loaders", nargs="+", default=["legacy", "streaming"])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.rf2
+        if path is None:
+            path = os.path.join(tmp_dir, "sct2_Relationship_Full_SYNTH.txt")
+            write_synthetic_rf2(path, args.concepts)
+
+        report = {"file": path, "file_size_mb": round(os.path.getsize(path) / 1e6, 1),
+                  "results": run(path, args.loaders)}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
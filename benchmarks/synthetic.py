@@ -0,0 +1,94 @@
+import os
+import random
+
+import pandas as pd
+
+RF2_HEADER = ["id", "effectiveTime", "active", "moduleId", "sourceId", "destinationId",
+              "relationshipGroup", "typeId", "characteristicTypeId", "modifierId"]
+ROOT_CODE = "138875005"
+IS_A = "116680003"
+FINDING_SITE = "363698007"
+
+
+def write_synthetic_rf2(path, n_concepts, depth=16, seed=0):
+    """
+    Write a synthetic RF2 Full relationship file shaped like SNOMED CT: a layered DAG of
+    the given depth under the root, where every concept has 1-3 is-a parents in the levels
+    above it (mostly the previous one), some relationships are inactivated in a later
+    release and there are attribute relationships of another type. Rows are sorted by
+    effectiveTime like the Full release.
+    """
+    rng = random.Random(seed)
+    codes = [ROOT_CODE] + [str(100000000 + i * 7) for i in range(n_concepts)]
+
+    # Level sizes grow geometrically like the upper SNOMED CT hierarchy, then stay flat
+    weights = [min(2.0 ** level, 2.0 ** (depth // 2)) for level in range(depth)]
+    sizes = [max(1, int(n_concepts * w / sum(weights))) for w in weights]
+    sizes[-1] += n_concepts - sum(sizes)
+    level_start = [1]
+    for size in sizes:
+        level_start.append(level_start[-1] + size)
+
+    rows = []
+    rel_id = 1000000
+    for level, size in enumerate(sizes):
+        for i in range(level_start[level], level_start[level + 1]):
+            if level == 0:
+                candidates = [0]
+            else:
+                # Most parents come from the previous level, some skip one level
+                parent_level = level - 1 if level == 1 or rng.random() < 0.85 else level - 2
+                candidates = range(level_start[parent_level], level_start[parent_level + 1])
+            # Parents are taken around the same relative position in the level above, so that
+            # neighbouring concepts and the parents of a concept share ancestors as in SNOMED CT
+            position = (i - level_start[level]) * len(candidates) // size
+            first = min(len(candidates) - 1, max(0, position + rng.randint(-5, 5)))
+            near = candidates[max(0, first - 5):first + 5]
+            n_parents = min(len(near), rng.choice([1, 1, 1, 2, 3]))
+            for parent in {candidates[first]} | set(rng.sample(near, n_parents - 1)):
+                rel_id += 1
+                release = rng.choice(["20020131", "20100131", "20180131"])
+                rows.append((str(rel_id), release, "1", codes[i], codes[parent], IS_A))
+                if rng.random() < 0.05:
+                    rows.append((str(rel_id), "20240901", "0", codes[i], codes[parent], IS_A))
+                if rng.random() < 0.3:
+                    rel_id += 1
+                    rows.append((str(rel_id), release, "1", codes[i], codes[rng.randrange(i)], FINDING_SITE))
+    rows.sort(key=lambda row: (row[1], row[0]))
+
+    with open(path, "w") as f:
+        f.write("\t".join(RF2_HEADER) + "\n")
+        for rel_id, release, active, source, destination, type_id in rows:
+            f.write("\t".join([rel_id, release, active, "900000000000207008", source, destination,
+                               "0", type_id, "900000000000011006", "900000000000451002"]) + "\n")
+    return codes
+
+
+def write_scaled_corpus(src_path, out_path, factor):
+    """
+    Write a processed corpus with the mentions of src_path repeated factor times, each copy
+    in differently named documents so that the mentions stay distinct.
+    """
+    df = pd.read_csv(src_path, sep='\t', dtype={'code': str})
+    copies = [df.assign(filename=df["filename"] + f"_{i}") if i else df for i in range(factor)]
+    pd.concat(copies, ignore_index=True).to_csv(out_path, sep='\t', index=False)
+
+
+def write_synthetic_variables(path, codes, n_variables, seed=0):
+    """
+    Write a variables file with n_variables rows: half of them use codes of the corpora (codes)
+    and the rest codes that are not annotated, like a long clinical variables list.
+    """
+    rng = random.Random(seed)
+    codes = sorted(set(codes))
+    n_found = min(len(codes), n_variables // 2)
+    ls_codes = rng.sample(codes, n_found) + [str(900000000 + i * 7) for i in range(n_variables - n_found)]
+    labels = ["ENFERMEDAD", "SINTOMA", "FARMACO", "PROCEDIMIENTO"]
+    df = pd.DataFrame({"ID": [f"SYN-{i}" for i in range(n_variables)],
+                       "name": [f"Variable {i}" for i in range(n_variables)],
+                       "code": ls_codes,
+                       "semantic_tag": "finding",
+                       "label": [rng.choice(labels) for _ in range(n_variables)],
+                       "term": [f"Term {i}" for i in range(n_variables)]})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, sep='\t', index=False)
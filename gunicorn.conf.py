@@ -0,0 +1,13 @@
+# gunicorn -c gunicorn.conf.py wsgi:server
+# (the app config is not imported as "config", which is a gunicorn setting)
+import src.config as app_config
+
+bind = app_config.BIND
+workers = app_config.WORKERS
+threads = app_config.THREADS
+
+# Import wsgi.py, which preloads the data, in the master before forking the workers
+preload_app = True
+
+# Reports not precomputed can take a while, they run in background callbacks
+timeout = 120
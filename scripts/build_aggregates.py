@@ -0,0 +1,22 @@
+import argparse
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import src.config as config
+import src.loader as loader
+from src.ingest import rebuild_aggregate
+
+parser = argparse.ArgumentParser(description="Write the mention counts of the processed corpora used by the coverage report")
+parser.add_argument("--corpora", nargs="+", default=config.ls_corpora)
+args = parser.parse_args()
+
+for corpus in args.corpora:
+    if not os.path.exists(loader.corpus_path(corpus)):
+        print(f"Skipping {corpus}, {loader.corpus_path(corpus)} not found")
+        continue
+
+    out_path = rebuild_aggregate(corpus)
+    n_mentions = len(loader.read_corpus_file(loader.corpus_path(corpus), columns=["code"]))
+    n_rows = len(loader.read_corpus_file(out_path, columns=["code"]))
+    print(f"Saved {out_path} ({n_rows} rows for {n_mentions} mentions)")
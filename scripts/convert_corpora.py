@@ -0,0 +1,33 @@
+import argparse
+import glob
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import pandas as pd
+
+# Columns stored dictionary-encoded: few distinct values repeated over all mentions
+CATEGORICAL_COLUMNS = ["filename", "label", "code", "semantic_rel", "ancestor"]
+
+parser = argparse.ArgumentParser(description="Convert processed corpora from TSV to Parquet")
+parser.add_argument("--data-folder", default="data/processed")
+args = parser.parse_args()
+
+ls_files = sorted(glob.glob(os.path.join(args.data_folder, "*.tsv")) +
+                  glob.glob(os.path.join(args.data_folder, "*_parents", "*.tsv")) +
+                  glob.glob(os.path.join(args.data_folder, "ancestors", "*.tsv")))
+
+for path in ls_files:
+    df = pd.read_csv(path, sep='\t', dtype={'code': str, 'ancestor': str})
+    df = df.astype({col: "category" for col in CATEGORICAL_COLUMNS if col in df.columns})
+    df = df.astype({col: "int32" for col in ["off0", "off1"] if col in df.columns})
+    df = df.astype({col: "int16" for col in ["depth"] if col in df.columns})
+
+    # Parents are stored as a native list column instead of a stringified Python list
+    if "code_wp" in df.columns:
+        df["code_wp"] = df["code_wp"].str.strip("[]").str.replace("'", "", regex=False).str.split(", ")
+        df["code_wp"] = df["code_wp"].apply(lambda parents: [p for p in parents if p])
+
+    out_path = path[:-len(".tsv")] + ".parquet"
+    df.to_parquet(out_path, index=False, compression="zstd")
+    print(f"Saved {out_path} ({os.path.getsize(out_path) / 1e6:.1f} MB, TSV {os.path.getsize(path) / 1e6:.1f} MB)")
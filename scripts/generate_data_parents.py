@@ -1,28 +1,95 @@
-import pandas as pd
+import argparse
+import multiprocessing
 import os
 import sys
 sys.path.append(os.getcwd())
 
+import pandas as pd
+
+import src.config as config
+import src.loader as loader
 from src.ontology.SnomedCT import SnomedCT
+from src.preprocessing import as_strings
+
+# Compiled ontology snapshots, reused by later runs instead of parsing the RF2 release again
+SNAPSHOT_FOLDER = "data/ontology/"
+
+# Ancestor table of the codes of all corpora, shared with the forked workers
+_ANCESTORS = None
+
+
+def read_codes(corpus):
+    """Codes of a corpus (TSV or Parquet), including the ingested segments counted in its aggregate."""
+    return as_strings(loader.read_corpus_file(loader.counts_path(corpus), columns=["code"])["code"])
+
+
+def write_corpus(corpus, levels, write_ancestors):
+    df_data = loader.read_corpus_file(loader.corpus_path(corpus))
+    codes = as_strings(df_data["code"])
+    df_ancestors = _ANCESTORS[_ANCESTORS["code"].isin(read_codes(corpus).unique())]
+
+    # The tables are written as TSV, which the loader prefers to an older Parquet conversion
+    if write_ancestors:
+        out_path = os.path.join(loader.DATA_FOLDER, "ancestors", f"{corpus}.tsv")
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        df_ancestors.to_csv(out_path, index=False, sep="\t")
+
+    # Files with the stringified list of parents per mention, as used by the app before the ancestor tables.
+    # The app still reads 1_parents without an ancestor table, the lists do not give the depth of deeper parents
+    for n_parents in levels:
+        df_level = df_ancestors if n_parents == config.ALL_PARENTS else df_ancestors[df_ancestors["depth"] <= n_parents]
+        code_wp = df_level.sort_values(["code", "ancestor"]).groupby("code")["ancestor"].agg(lambda parents: str(list(parents)))
 
-N_PARENTS = 1
-DATA_FOLDER = "data/processed/"
-OUTPUT_FOLDER = os.path.join(DATA_FOLDER, f"{N_PARENTS}_parents")
+        output_folder = os.path.join(loader.DATA_FOLDER, loader.parents_folder(n_parents))
+        os.makedirs(output_folder, exist_ok=True)
+        df_data["code_wp"] = codes.map(code_wp).fillna("[]")
+        df_data.to_csv(os.path.join(output_folder, f"{corpus}.tsv"), index=False, sep="\t")
 
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    return corpus
 
-relationship_file = "/home/abecerra/Documents/SnomedCT_InternationalRF2_PRODUCTION_20240901T120000Z/Full/Terminology/sct2_Relationship_Full_INT_20240901.txt"
 
-sct = SnomedCT(file_name_rel=relationship_file, root_concept_code = "138875005", relation_types=["116680003"])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expand the codes of the processed corpora with their SNOMED CT ancestors")
+    parser.add_argument("--relationship-file", required=True,
+                        help="RF2 relationship file, e.g. .../Full/Terminology/sct2_Relationship_Full_INT_20240901.txt")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_FOLDER, help="Folder of the compiled ontology snapshots")
+    parser.add_argument("--corpora", nargs="+", default=config.ls_corpora)
+    parser.add_argument("--levels", nargs="*", type=int, default=[config.N_MAX_PARENTS],
+                        help=f"Write data/processed/{{n}}_parents/ files for these numbers of parents "
+                             f"({config.ALL_PARENTS} for data/processed/all_parents/)")
+    parser.add_argument("--max-depth", type=int, default=None,
+                        help="Only expand the ancestors up to this depth, for --levels files that do not need more. "
+                             "The ancestor tables are then not written, the app would read them for every level, "
+                             "so it only serves 1 parent")
+    parser.add_argument("--no-ancestors", action="store_true", help="Do not write data/processed/ancestors/ tables")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
-# ls_corpora = ["total", "distemist", "symptemist", "medprocner", "pharmaconer", "cardioccc_temu"]
-ls_corpora = ["cardioccc_deepspanorm"]
+    # A truncated expansion must not end up in the tables served for all parents or deeper levels
+    if args.max_depth is not None and any(n_parents == config.ALL_PARENTS or n_parents > args.max_depth
+                                          for n_parents in args.levels):
+        parser.error("--levels must not be deeper than --max-depth")
+    write_ancestors = not args.no_ancestors and args.max_depth is None
+    if not args.no_ancestors and args.max_depth is not None:
+        print("Not writing the ancestor tables, they would be truncated to --max-depth")
 
-for corpus in ls_corpora:
-    DATA = f'data/processed/{corpus}.tsv'
+    ls_corpora = [corpus for corpus in args.corpora if os.path.exists(loader.corpus_path(corpus))]
+    for corpus in sorted(set(args.corpora) - set(ls_corpora)):
+        print(f"Skipping {corpus}, {loader.corpus_path(corpus)} not found")
 
-    df_data = pd.read_csv(DATA, sep='\t', dtype={'code': str})
-    df_data["code_wp"] = df_data["code"].apply(lambda x: sct.get_parents(x, levels=N_PARENTS))
+    sct = SnomedCT.open(args.relationship_file, snapshot_dir=args.snapshot_dir,
+                        root_concept_code="138875005", relation_types=["116680003"])
 
-    df_data.to_csv(os.path.join(OUTPUT_FOLDER, f"{corpus}.tsv"), index=False, sep="\t")
+    # Expand the distinct codes of all corpora once, for every requested depth at the same time
+    ls_codes = [read_codes(corpus) for corpus in ls_corpora]
+    max_depth = args.max_depth
+    if not write_ancestors and max_depth is None and config.ALL_PARENTS not in args.levels:
+        max_depth = max(args.levels, default=0)
+    _ANCESTORS = sct.expand_ancestors(pd.concat(ls_codes).unique(), max_depth=max_depth)
+    print(f"Expanded {_ANCESTORS['code'].nunique()} codes into {len(_ANCESTORS)} ancestors")
 
+    # Workers are forked so that they share the ancestor table instead of receiving a copy
+    with multiprocessing.get_context("fork").Pool(processes=min(args.workers, len(ls_corpora) or 1)) as pool:
+        ls_jobs = [pool.apply_async(write_corpus, (corpus, args.levels, write_ancestors)) for corpus in ls_corpora]
+        for job in ls_jobs:
+            print(f"Saved {job.get()}")
@@ -0,0 +1,22 @@
+import argparse
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import pandas as pd
+
+from src.ingest import ingest_batch, rebuild_aggregate
+
+parser = argparse.ArgumentParser(description="Append batches of annotated mentions to a processed corpus")
+parser.add_argument("corpus")
+parser.add_argument("batches", nargs="*", help="TSV files with the columns of data/processed/{corpus}.tsv")
+parser.add_argument("--rebuild", action="store_true",
+                    help="Recompute the aggregate from the corpus and all its segments (e.g. after rewriting the corpus)")
+args = parser.parse_args()
+
+if args.rebuild:
+    print(f"Saved {rebuild_aggregate(args.corpus)}")
+
+for path in args.batches:
+    df_batch = pd.read_csv(path, sep='\t', dtype={'code': str})
+    print(f"Saved {ingest_batch(args.corpus, df_batch)} ({len(df_batch)} mentions)")
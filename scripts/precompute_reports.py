@@ -0,0 +1,29 @@
+import argparse
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import src.config as config
+import src.loader as loader
+import src.visualization as viz
+from src.artifacts import write_artifact
+
+parser = argparse.ArgumentParser(description="Precompute every dashboard view into the artifacts folder")
+parser.add_argument("--output", default=config.ARTIFACTS_DIR, help="Artifacts folder")
+parser.add_argument("--projects", nargs="+", default=config.ls_projects)
+parser.add_argument("--corpora", nargs="+", default=config.ls_corpora)
+parser.add_argument("--parents", nargs="+", type=int, default=list(config.ls_possible_parents))
+args = parser.parse_args()
+
+for project in args.projects:
+    for n_parents in args.parents:
+        for corpus in args.corpora:
+            missing = [path for path in loader.report_inputs(project, corpus, n_parents) if not os.path.exists(path)]
+            if missing:
+                print(f"Skipping {project}/{corpus}/{loader.parents_folder(n_parents)}, missing {', '.join(missing)}")
+                continue
+
+            # One artifact per corpus, the app composes the views of several corpora from them
+            df_report, *ls_figures = viz.report_corpus(project, corpus, n_parents=n_parents, show=False)[1]
+            out_dir = write_artifact(project, corpus, n_parents, df_report, ls_figures, root=args.output)
+            print(f"Saved {out_dir}")
@@ -0,0 +1,122 @@
+import json
+import os
+
+import src.config as config
+import src.loader as loader
+from src.cache import file_hash
+from src.visualization import REPORT_INDEX, REPORT_VALUES
+
+# Bump when the layout or the contents of the artifacts change so that the app ignores old builds
+ARTIFACT_VERSION = 5
+
+
+def artifact_dir(project, corpus, n_parents, root=None):
+    root = root or config.ARTIFACTS_DIR
+    return os.path.join(root, f"v{ARTIFACT_VERSION}", project, loader.parents_folder(n_parents), corpus)
+
+
+def write_artifact(project, corpus, n_parents, df_report, figures, root=None):
+    """
+    Store the report rows (REPORT_INDEX and REPORT_VALUES columns of report_corpus) and figures
+    of one (project, corpus, n_parents) view. The views of several corpora are composed from
+    these at request time (see load_view).
+
+    The manifest records the hash of every input file so that the app can tell when the
+    artifact no longer matches the data.
+    """
+    out_dir = artifact_dir(project, corpus, n_parents, root=root)
+    os.makedirs(out_dir, exist_ok=True)
+
+    manifest = {
+        "version": ARTIFACT_VERSION,
+        "project": project,
+        "corpus": corpus,
+        "n_parents": n_parents,
+        "inputs": {path: file_hash(path) for path in loader.report_inputs(project, corpus, n_parents)},
+    }
+    report = {
+        "columns": REPORT_INDEX + REPORT_VALUES,
+        "data": json.loads(df_report[REPORT_INDEX + REPORT_VALUES].to_json(orient="records")),
+    }
+
+    _write_json(os.path.join(out_dir, "report.json"), report)
+    _write_json(os.path.join(out_dir, "figures.json"), [json.loads(fig.to_json()) for fig in figures])
+    # The manifest is written last: an artifact without it is incomplete and ignored
+    _write_json(os.path.join(out_dir, "manifest.json"), manifest)
+    return out_dir
+
+
+def load_artifact(project, corpus, n_parents, root=None):
+    """
+    Return (report, figures) for a precomputed view, or None if it is missing or stale.
+    report is a dict with "columns" and "data" records and figures a list of figure dicts,
+    so no pandas or plotly work is needed to serve them.
+    """
+    in_dir = artifact_dir(project, corpus, n_parents, root=root)
+    try:
+        with open(os.path.join(in_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        inputs = loader.report_inputs(project, corpus, n_parents)
+        if set(manifest["inputs"]) != set(inputs):
+            return None
+        if any(file_hash(path) != digest for path, digest in manifest["inputs"].items()):
+            return None
+
+        with open(os.path.join(in_dir, "report.json")) as f:
+            report = json.load(f)
+        with open(os.path.join(in_dir, "figures.json")) as f:
+            figures = json.load(f)
+    except (OSError, ValueError, KeyError):
+        return None
+    return report, figures
+
+
+def load_view(project, ls_corpora, n_parents, root=None):
+    """
+    Return (table, figures) of a report of several corpora composed from their artifacts, as
+    generate_report_table would build it, or None if the artifact of any corpus is missing or
+    stale. table is a dict with "columns", "types" (DataTable column types) and "data" records.
+    """
+    ls_corpora = list(dict.fromkeys(ls_corpora))
+    d_reports, ls_figures = {}, []
+    for corpus in ls_corpora:
+        artifact = load_artifact(project, corpus, n_parents, root=root)
+        if artifact is None:
+            return None
+        d_reports[corpus] = artifact[0]["data"]
+        ls_figures += artifact[1]
+    return compose_table(d_reports), ls_figures
+
+
+def compose_table(d_reports):
+    """
+    Pivot the report records of several corpora ({corpus: records}) to one row per
+    REPORT_INDEX and one column per metric and corpus, in plain Python. The rows and columns
+    are in the order of generate_report_table: by decreasing first column (missing values
+    last), then by index.
+    """
+    rows = {}
+    for corpus, records in d_reports.items():
+        for record in records:
+            key = tuple(record[col] for col in REPORT_INDEX)
+            row = rows.setdefault(key, dict(zip(REPORT_INDEX, key)))
+            for col in REPORT_VALUES:
+                row[f"{col}_{corpus}"] = record[col]
+
+    value_columns = [f"{col}_{corpus}" for col in REPORT_VALUES for corpus in sorted(d_reports)]
+    columns = REPORT_INDEX + value_columns
+    data = [{col: row.get(col) for col in columns} for _, row in sorted(rows.items())]
+    if value_columns:
+        first = value_columns[0]
+        data = sorted([row for row in data if row[first] is not None], key=lambda row: row[first], reverse=True) + \
+            [row for row in data if row[first] is None]
+
+    types = ["text"] * len(REPORT_INDEX) + ["numeric"] * len(value_columns)
+    return {"columns": columns, "types": types, "data": data}
+
+
+def _write_json(path, obj):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import plotly.io as pio
+
+import src.config as config
+import src.metrics as metrics
+
+# Bump when the structure or the contents of the cached results change so that old disk entries are ignored
+CACHE_VERSION = 4
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """
+    SHA-1 of the file contents. The digest is memoized by (mtime, size) so the file is
+    only read again when it changes on disk.
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _file_hashes_lock:
+        entry = _file_hashes.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[path] = (stamp, digest)
+    return digest
+
+
+def make_key(project, corpus, n_parents, inputs):
+    """Cache key for a report: selection plus content hashes of the input files."""
+    return (CACHE_VERSION, project, corpus, n_parents) + tuple(file_hash(path) for path in inputs)
+
+
+class ResultCache:
+    """
+    Two-tier cache for report_corpus results, i.e. (df_code_ovr, (df_report, *figures)).
+
+    The memory tier is an LRU dict bounded by max_entries. When cache_dir is set, results
+    are also written to disk (dataframes as pickle, figures as plotly JSON) so they survive
+    restarts and can be shared by several processes.
+    """
+
+    def __init__(self, max_entries, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.count_cache("result", hit=True)
+                return self._entries[key]
+
+        result = self._read_disk(key)
+        if result is not None:
+            self._set_memory(key, result)
+        metrics.count_cache("result", hit=result is not None)
+        return result
+
+    def set(self, key, result):
+        self._set_memory(key, result)
+        self._write_disk(key, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _set_memory(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _entry_dir(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "frames.pkl"), "rb") as f:
+                df_code_ovr, df_report = pickle.load(f)
+            with open(os.path.join(entry_dir, "figures.json")) as f:
+                figures = [pio.from_json(fig) for fig in json.load(f)]
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        return df_code_ovr, (df_report, *figures)
+
+    def _write_disk(self, key, result):
+        if not self.cache_dir:
+            return
+        df_code_ovr, (df_report, *figures) = result
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        # Write to temporary files and rename so that concurrent readers never see partial entries
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        figures_path = os.path.join(entry_dir, "figures.json")
+        with open(figures_path + tmp_suffix, "w") as f:
+            json.dump([fig.to_json() for fig in figures], f)
+        os.replace(figures_path + tmp_suffix, figures_path)
+
+        frames_path = os.path.join(entry_dir, "frames.pkl")
+        with open(frames_path + tmp_suffix, "wb") as f:
+            pickle.dump((df_code_ovr, df_report), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(frames_path + tmp_suffix, frames_path)
+
+
+RESULT_CACHE = ResultCache(max_entries=config.RESULT_CACHE_SIZE, cache_dir=config.RESULT_CACHE_DIR)
@@ -1,5 +1,69 @@
+import os
+
 from dash import html
 
+N_MAX_PARENTS = 1
+# Number of parents meaning every ancestor of the code
+ALL_PARENTS = -1
+
+# List of available projects and corpora
+ls_projects = ["DT4H", "BARITONE", "CHAGAS"]
+ls_corpora = ["total", "distemist", "symptemist", "medprocner", "pharmaconer", "cardioccc_temu", "cardioccc_deepspanorm"]
+# Levels above N_MAX_PARENTS need the ancestor tables of scripts/generate_data_parents.py
+ls_possible_parents = [0, 1, 2, 3, ALL_PARENTS]
+
+# Maximum number of corpus/variables dataframes kept in memory by src.loader
+FRAME_CACHE_SIZE = int(os.environ.get("COVERAGE_FRAME_CACHE_SIZE", 16))
+
+# Mentions read at a time when a corpus file is counted, which bounds the memory of loading it
+READ_CHUNK_SIZE = int(os.environ.get("COVERAGE_READ_CHUNK_SIZE", 1_000_000))
+
+# Spans per variable of the candidates that src.search keeps for each (project, corpus, parents),
+# requests with a smaller limit are cut from them and larger ones are computed every time
+CANDIDATES_CACHE_LIMIT = int(os.environ.get("COVERAGE_CANDIDATES_CACHE_LIMIT", 20))
+
+# Maximum number of report results kept in memory by src.cache and optional folder
+# for the on-disk tier (disabled when empty)
+RESULT_CACHE_SIZE = int(os.environ.get("COVERAGE_RESULT_CACHE_SIZE", 64))
+RESULT_CACHE_DIR = os.environ.get("COVERAGE_RESULT_CACHE_DIR") or None
+
+# Folder with the precomputed reports written by scripts/precompute_reports.py
+ARTIFACTS_DIR = os.environ.get("COVERAGE_ARTIFACTS_DIR", "artifacts")
+
+# Number of processes computing the corpora of a multi-corpus report (one per CPU when 0)
+REPORT_WORKERS = int(os.environ.get("COVERAGE_REPORT_WORKERS", 0))
+
+# Production server (gunicorn.conf.py): address, worker processes and threads per worker
+BIND = os.environ.get("COVERAGE_BIND", "0.0.0.0:8001")
+WORKERS = int(os.environ.get("COVERAGE_WORKERS", 4))
+THREADS = int(os.environ.get("COVERAGE_THREADS", 4))
+
+# Numbers of parents whose tables are read before the server forks its workers, and compiled
+# SNOMED CT snapshot (.sctsnap) loaded along with them (none when empty)
+PRELOAD_PARENTS = [int(n) for n in os.environ.get("COVERAGE_PRELOAD_PARENTS", str(N_MAX_PARENTS)).split(",") if n]
+ONTOLOGY_SNAPSHOT = os.environ.get("COVERAGE_ONTOLOGY_SNAPSHOT") or None
+
+# Build the bar charts of the reports without plotly express, with at most FIGURE_MAX_TRACES
+# traces per chart (the rest is grouped as "other")
+LIGHT_FIGURES = os.environ.get("COVERAGE_LIGHT_FIGURES", "1") == "1"
+FIGURE_MAX_TRACES = int(os.environ.get("COVERAGE_FIGURE_MAX_TRACES", 20))
+
+# Folder of the stage timings and cache counts served at /coverage/metrics, time window in
+# seconds they are aggregated over, and seconds each process keeps them in memory before adding
+# them to the folder
+METRICS_DIR = os.environ.get("COVERAGE_METRICS_DIR", "cache/metrics")
+METRICS_WINDOW = int(os.environ.get("COVERAGE_METRICS_WINDOW", 3600))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("COVERAGE_METRICS_FLUSH_INTERVAL", 10))
+
+# Folder of the cProfile captures, profiling is disabled when empty. Requests with the header
+# "X-Coverage-Profile: 1" (or ?profile=1) and the reports computed in background jobs are profiled
+PROFILE_DIR = os.environ.get("COVERAGE_PROFILE_DIR") or None
+
+# Folder of the job queue and results of the app background callbacks, and maximum time in
+# seconds a report job holds its lock before identical requests stop waiting for it
+BACKGROUND_CACHE_DIR = os.environ.get("COVERAGE_BACKGROUND_CACHE_DIR", "cache/background")
+REPORT_JOB_TIMEOUT = int(os.environ.get("COVERAGE_REPORT_JOB_TIMEOUT", 900))
+
 MAIN_PAR_STYLE = {
                         "color": "#333",
                         "fontSize": "20px",
@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+import src.loader as loader
+from src.preprocessing import as_strings, encode_codes, process_composites, resolve_parent_codes
+
+MATRIX_COLUMNS = ["project", "ID", "name", "code", "corpus", "n_parents", "count"]
+
+
+def corpus_code_counts(corpus):
+    """
+    Mentions of a corpus collapsed to one row per (code, composite or not) with their count,
+    all the coverage counts depend on.
+    """
+    df = loader.load_counts(corpus)
+    counts = df["count"] if "count" in df.columns else 1
+    df = pd.DataFrame({"code": as_strings(df["code"]),
+                       "semantic_rel": (df["semantic_rel"] == "COMPOSITE").map({True: "COMPOSITE", False: ""}),
+                       "count": counts})
+    df = df.groupby(["code", "semantic_rel"]).aggregate({"count": "sum"}).reset_index()
+    return encode_codes(df)
+
+
+def variable_counts(df_codes, df_vars, n_parents, df_parents=None):
+    """
+    Mentions matched by each variable, i.e. the count_ID of generate_df_codes, from the code
+    counts of corpus_code_counts. Only variables with mentions are returned.
+    """
+    df = df_codes.assign(code_src_id=df_codes["code_id"])
+    df = process_composites(df, df_vars)
+
+    var_ids = df_vars["code_id"].unique()
+    if n_parents != 0:
+        df_parent_lookup = resolve_parent_codes(df_parents, var_ids).set_index("code_id")
+        mask = (~df["code_id"].isin(var_ids)) & df["code_src_id"].isin(df_parent_lookup.index)
+        df.loc[mask, "code_id"] = df.loc[mask, "code_src_id"].map(df_parent_lookup["parent_id"])
+
+    counts = df.groupby("code_id")["count"].sum()
+    df_counts = df_vars[["ID", "name", "code"]].assign(count=df_vars["code_id"].map(counts).fillna(0).astype("int64"))
+    df_counts = df_counts.groupby("ID").aggregate({"name": "first", "code": "first", "count": "sum"}).reset_index()
+    return df_counts[df_counts["count"] > 0]
+
+
+def variable_subtree_counts(df_codes, df_vars, n_parents, descendant_index=None):
+    """
+    Mentions in the subtree of each variable, i.e. of its code and of the codes up to
+    n_parents levels below it (all of them for config.ALL_PARENTS), from the code counts of
+    corpus_code_counts. Unlike variable_counts a mention counts for every variable above it,
+    not only for the nearest one. Only variables with mentions are returned.
+    """
+    df = df_codes.assign(code_src_id=df_codes["code_id"])
+    df = process_composites(df, df_vars)
+    var_ids = df_vars["code_id"].to_numpy()
+    counts = np.bincount(df["code_id"].to_numpy(), weights=df["count"].to_numpy(dtype=np.int64),
+                         minlength=var_ids.max(initial=-1) + 1).astype(np.int64)
+
+    if n_parents == 0 or descendant_index is None:
+        subtree = counts[var_ids]
+    else:
+        subtree = descendant_index.subtree_counts(counts, var_ids, None if n_parents == config.ALL_PARENTS else n_parents)
+
+    df_counts = df_vars[["ID", "name", "code"]].assign(count=subtree.astype("int64"))
+    df_counts = df_counts.groupby("ID").aggregate({"name": "first", "code": "first", "count": "sum"}).reset_index()
+    return df_counts[df_counts["count"] > 0]
+
+
+def available_levels(corpus, levels):
+    return [n_parents for n_parents in levels
+            if all(os.path.exists(path) for path in loader.corpus_inputs(corpus, n_parents))]
+
+
+def compute_coverage_matrix(projects=config.ls_projects, corpora=config.ls_corpora, levels=config.ls_possible_parents,
+                            descendants=False):
+    """
+    Sparse variable x corpus x number of parents matrix of mention counts for several projects,
+    in long format (MATRIX_COLUMNS), with a row per non-zero count. With descendants, the
+    counts are the mentions in the subtree of each variable (see variable_subtree_counts).
+
+    Every corpus and parents table is read once and collapsed to counts per code, and the
+    variables of all projects are matched against these counts, instead of running the
+    report pipeline for each (project, corpus, level). Projects or corpora without data,
+    and levels without parents tables, are skipped.
+    """
+    d_vars = {project: loader.load_variables(project) for project in projects
+              if os.path.exists(loader.variables_path(project))}
+
+    ls_counts = []
+    for corpus in corpora:
+        if not os.path.exists(loader.counts_path(corpus)):
+            continue
+        df_codes = corpus_code_counts(corpus)
+        for n_parents in available_levels(corpus, levels):
+            if descendants:
+                descendant_index = loader.load_descendants(corpus, n_parents) if n_parents != 0 else None
+            else:
+                df_parents = loader.load_parents(corpus, n_parents) if n_parents != 0 else None
+            for project, df_vars in d_vars.items():
+                if descendants:
+                    df_counts = variable_subtree_counts(df_codes, df_vars, n_parents, descendant_index)
+                else:
+                    df_counts = variable_counts(df_codes, df_vars, n_parents, df_parents)
+                ls_counts.append(df_counts.assign(project=project, corpus=corpus, n_parents=n_parents))
+
+    if not ls_counts:
+        return pd.DataFrame(columns=MATRIX_COLUMNS)
+    return pd.concat(ls_counts, ignore_index=True)[MATRIX_COLUMNS]
+
+
+def matrix_inputs(projects=config.ls_projects, corpora=config.ls_corpora, levels=config.ls_possible_parents):
+    """Files compute_coverage_matrix reads, used to key its cache."""
+    paths = [loader.variables_path(project) for project in projects if os.path.exists(loader.variables_path(project))]
+    for corpus in corpora:
+        if os.path.exists(loader.counts_path(corpus)):
+            paths += sorted(set(path for n_parents in available_levels(corpus, levels)
+                                for path in loader.corpus_inputs(corpus, n_parents)))
+    return paths
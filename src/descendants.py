@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class DescendantIndex:
+    """
+    Closure table of a hierarchy transposed to CSR arrays: the descendants of concept i are
+    descendant_ids[indptr[i]:indptr[i + 1]], sorted by depth (distance to i). The descendants
+    of i up to depth k are therefore a prefix of its row, so the mentions in the subtrees of
+    many concepts are answered together with one binary search per concept and differences
+    of a cumulative sum, without walking the graph.
+
+    SNOMED CT is a DAG, so a concept can appear in several subtrees; the closure keeps every
+    (descendant, ancestor) pair with its shortest depth.
+    """
+
+    def __init__(self, code_ids, ancestor_ids, depths):
+        """Build the index from (code, ancestor, depth) pairs of integer concept ids."""
+        code_ids, ancestor_ids = np.asarray(code_ids, dtype=np.int64), np.asarray(ancestor_ids, dtype=np.int64)
+        depths = np.asarray(depths, dtype=np.int64)
+        n = int(max(code_ids.max(initial=-1), ancestor_ids.max(initial=-1))) + 1
+
+        # A pair listed several times (e.g. reached by several paths) keeps its shortest depth
+        order = np.lexsort((depths, code_ids, ancestor_ids))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (ancestor_ids[order][1:] != ancestor_ids[order][:-1]) | (code_ids[order][1:] != code_ids[order][:-1])
+        code_ids, ancestor_ids, depths = code_ids[order[first]], ancestor_ids[order[first]], depths[order[first]]
+
+        order = np.lexsort((code_ids, depths, ancestor_ids))
+        self.descendant_ids = code_ids[order].astype(np.int32)
+        self.depths = depths[order].astype(np.int16)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ancestor_ids, minlength=n), out=self.indptr[1:])
+
+        # Rows and depths combined in a single sorted key for the depth-limited row ends
+        self.max_depth = int(depths.max(initial=0))
+        self._row_keys = ancestor_ids[order] * (self.max_depth + 1) + self.depths
+
+    @classmethod
+    def from_parents(cls, df_parents):
+        """Index of a (code_id, parent_id, depth) table, e.g. loader.load_parents of a corpus."""
+        return cls(df_parents["code_id"].to_numpy(), df_parents["parent_id"].to_numpy(), df_parents["depth"].to_numpy())
+
+    @classmethod
+    def from_ontology(cls, sct):
+        """Index of the whole hierarchy of a SnomedCT with an ancestor index, in its vocabulary ids."""
+        code_ids = np.repeat(np.arange(len(sct.ancestor_indptr) - 1), np.diff(sct.ancestor_indptr))
+        return cls(code_ids, sct.ancestor_indices, sct.ancestor_depths)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def row_ranges(self, root_ids, max_depth=None):
+        """
+        (start, end) positions of the descendants of root_ids up to max_depth levels below
+        them (all of them when None). Ids outside the index have empty ranges.
+        """
+        root_ids = np.asarray(root_ids, dtype=np.int64)
+        known = (root_ids >= 0) & (root_ids < len(self))
+        safe_ids = np.where(known, root_ids, 0)
+        starts = np.where(known, self.indptr[safe_ids], 0)
+        if max_depth is None or max_depth >= self.max_depth:
+            ends = np.where(known, self.indptr[safe_ids + 1], 0)
+        else:
+            ends = np.searchsorted(self._row_keys, safe_ids * (self.max_depth + 1) + max_depth, side="right")
+            ends = np.where(known, ends, 0)
+        return starts, ends
+
+    def get_descendants(self, root_id, max_depth=None):
+        """Ids of the descendants of root_id up to max_depth levels below it."""
+        starts, ends = self.row_ranges([root_id], max_depth)
+        return self.descendant_ids[starts[0]:ends[0]]
+
+    def subtree_counts(self, counts, root_ids, max_depth=None):
+        """
+        Sum of counts (indexed by concept id) over each root and its descendants up to
+        max_depth levels below it. Concepts beyond the end of counts count 0.
+        """
+        counts = np.asarray(counts)
+        root_ids = np.asarray(root_ids, dtype=np.int64)
+        padded = np.zeros(max(len(counts), len(self), int(root_ids.max(initial=-1)) + 1), dtype=counts.dtype)
+        padded[:len(counts)] = counts
+
+        cumulative = np.zeros(len(self.descendant_ids) + 1, dtype=counts.dtype)
+        np.cumsum(padded[self.descendant_ids], out=cumulative[1:])
+        starts, ends = self.row_ranges(root_ids, max_depth)
+        own = np.where(root_ids >= 0, padded[np.maximum(root_ids, 0)], 0)
+        return own + cumulative[ends] - cumulative[starts]
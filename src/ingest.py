@@ -0,0 +1,68 @@
+import glob
+import os
+
+import src.loader as loader
+from src.preprocessing import count_mentions, merge_aggregates
+
+MENTION_COLUMNS = ["filename", "label", "off0", "off1", "span", "code", "semantic_rel"]
+
+
+def segments_folder(corpus):
+    return os.path.join(loader.DATA_FOLDER, "segments", corpus)
+
+
+def list_segments(corpus):
+    """Segment files of a corpus in ingestion order."""
+    return sorted(glob.glob(os.path.join(segments_folder(corpus), "*.tsv")))
+
+
+def read_aggregate(corpus):
+    return loader.read_corpus_file(loader.aggregate_path(corpus))
+
+
+def write_aggregate(corpus, df_aggregate):
+    """Write the aggregate through a temporary file so that readers never see a partial table."""
+    path = loader.aggregate_path(corpus)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df_aggregate.to_csv(tmp_path, sep='\t', index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def rebuild_aggregate(corpus):
+    """
+    Recompute the aggregate of a corpus from its base file and every segment, adding the counts
+    of each file to the running aggregate.
+    """
+    df_aggregate = loader.count_corpus_file(loader.corpus_path(corpus))
+    for path in list_segments(corpus):
+        df_aggregate = merge_aggregates([df_aggregate, loader.count_corpus_file(path)])
+    return write_aggregate(corpus, df_aggregate)
+
+
+def ingest_batch(corpus, df_batch):
+    """
+    Append a batch of annotated mentions to a corpus.
+
+    The batch is stored as a new segment and its counts are added to the corpus aggregate,
+    so the cost is proportional to the batch and the aggregate, not to the whole corpus.
+    Returns the path of the new segment.
+    """
+    missing = [col for col in MENTION_COLUMNS if col not in df_batch.columns]
+    if missing:
+        raise ValueError(f"Batch is missing columns {missing}")
+
+    # The first batch starts the aggregate from the mentions already in the corpus
+    if not os.path.exists(loader.aggregate_path(corpus)):
+        rebuild_aggregate(corpus)
+
+    folder = segments_folder(corpus)
+    os.makedirs(folder, exist_ok=True)
+    ls_segments = list_segments(corpus)
+    n_segment = int(os.path.basename(ls_segments[-1])[:-len(".tsv")]) + 1 if ls_segments else 0
+    segment_path = os.path.join(folder, f"{n_segment:06d}.tsv")
+    df_batch[MENTION_COLUMNS].to_csv(segment_path, sep='\t', index=False)
+
+    write_aggregate(corpus, merge_aggregates([read_aggregate(corpus), count_mentions(df_batch)]))
+    return segment_path
@@ -0,0 +1,39 @@
+import diskcache
+
+import src.config as config
+import src.metrics as metrics
+
+# Shared by the app processes and the background callback workers
+BACKGROUND_CACHE = diskcache.Cache(config.BACKGROUND_CACHE_DIR)
+
+
+def get_result(key):
+    """Result stored under key by a finished run_once, or None."""
+    result = BACKGROUND_CACHE.get(key)
+    metrics.count_cache("report", hit=result is not None)
+    return result
+
+
+def run_once(key, compute_fn, on_wait=None):
+    """
+    Return compute_fn() stored under key in the background cache, computing it only once when
+    identical requests arrive at the same time: later callers wait for the running job (calling
+    on_wait first) and read its result.
+    """
+    result = get_result(key)
+    if result is not None:
+        return result
+    return compute_once(key, compute_fn, on_wait=on_wait)
+
+
+def compute_once(key, compute_fn, on_wait=None):
+    """The computation part of run_once, for callers that already looked key up with get_result."""
+    lock = diskcache.Lock(BACKGROUND_CACHE, f"lock:{key}", expire=config.REPORT_JOB_TIMEOUT)
+    if on_wait is not None and lock.locked():
+        on_wait()
+    with lock:
+        result = BACKGROUND_CACHE.get(key)
+        if result is None:
+            result = compute_fn()
+            BACKGROUND_CACHE.set(key, result)
+    return result
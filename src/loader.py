@@ -0,0 +1,325 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+
+import src.config as config
+import src.metrics as metrics
+from src.descendants import DescendantIndex
+from src.ontology.SnomedCT import SnomedCT
+from src.preprocessing import count_mentions, encode_codes, explode_ancestors, explode_parents, merge_aggregates, \
+    resolve_parent_codes
+
+DATA_FOLDER = "data/processed"
+VARIABLES_FOLDER = "data/variables"
+
+# Corpus columns used by the coverage report, the rest (filename, offsets) is not read
+REPORT_COLUMNS = ["label", "span", "code", "semantic_rel"]
+
+# Dtypes of the corpus columns read from TSV, offsets and counts are left to the parser
+CORPUS_DTYPES = {col: "category" for col in ["filename", "label", "span", "code", "semantic_rel", "code_wp"]}
+
+
+def _prefer_parquet(tsv_path):
+    """The Parquet version written by scripts/convert_corpora.py when it is at least as recent as the TSV."""
+    parquet_path = tsv_path[:-len(".tsv")] + ".parquet"
+    if os.path.exists(parquet_path) and \
+            (not os.path.exists(tsv_path) or os.stat(parquet_path).st_mtime_ns >= os.stat(tsv_path).st_mtime_ns):
+        return parquet_path
+    return tsv_path
+
+
+def parents_folder(n_parents):
+    """Folder name of a number of parents, e.g. "1_parents" or "all_parents"."""
+    return "all_parents" if n_parents == config.ALL_PARENTS else f"{n_parents}_parents"
+
+
+def corpus_path(corpus, n_parents=0):
+    """Path of the processed corpus file, with the code_wp parents column when n_parents != 0."""
+    if n_parents == 0:
+        return _prefer_parquet(os.path.join(DATA_FOLDER, f"{corpus}.tsv"))
+    return _prefer_parquet(os.path.join(DATA_FOLDER, parents_folder(n_parents), f"{corpus}.tsv"))
+
+
+def ancestors_path(corpus):
+    """Path of the (code, ancestor, depth) table written by scripts/generate_data_parents.py."""
+    return _prefer_parquet(os.path.join(DATA_FOLDER, "ancestors", f"{corpus}.tsv"))
+
+
+def aggregate_path(corpus):
+    """Path of the mention counts of a corpus maintained by src/ingest.py."""
+    return os.path.join(DATA_FOLDER, "aggregates", f"{corpus}.tsv")
+
+
+def counts_path(corpus):
+    """File the coverage of a corpus is computed from: its aggregate if any, the mentions otherwise."""
+    path = aggregate_path(corpus)
+    if os.path.exists(path):
+        return path
+    return corpus_path(corpus)
+
+
+def parents_path(corpus, n_parents):
+    """
+    File the parents of a corpus are read from: its ancestor table, which serves every level,
+    or the 1_parents corpus for one level. The parent lists of the other {n}_parents corpora do
+    not record the depth of each parent, so these levels need the ancestor table.
+    """
+    path = ancestors_path(corpus)
+    if os.path.exists(path) or n_parents != 1:
+        return path
+    return corpus_path(corpus, n_parents)
+
+
+def variables_path(project):
+    return os.path.join(VARIABLES_FOLDER, project, "processed", "variables.tsv")
+
+
+def translations_path(project):
+    """Labels of the variable codes by language, only some projects have them."""
+    return os.path.join(VARIABLES_FOLDER, project, "processed", "variables_trans.tsv")
+
+
+def corpus_inputs(corpus, n_parents=0):
+    """Files of a corpus the coverage with n_parents depends on."""
+    inputs = [counts_path(corpus)]
+    if n_parents != 0:
+        inputs.append(parents_path(corpus, n_parents))
+    return inputs
+
+
+def report_inputs(project, corpus, n_parents=0):
+    """Files a report depends on, used to key caches and detect stale artifacts."""
+    return corpus_inputs(corpus, n_parents) + [variables_path(project)]
+
+
+class FrameCache:
+    """
+    Process-wide LRU cache of dataframes read from disk.
+
+    Entries are keyed by path and invalidated when the file modification time changes,
+    so a regenerated TSV is picked up on the next request without restarting the app.
+    The frames are shared between callers and must not be modified in place.
+
+    Entries read within a pinned() block are kept in a separate map that max_entries does
+    not apply to, so that the frames preloaded before the server forks are never evicted.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._pinning = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def pinned(self):
+        """Pin the entries read in the block (see preload), not meant for concurrent use."""
+        self._pinning = True
+        try:
+            yield
+        finally:
+            self._pinning = False
+
+    def get(self, path, read_fn, key=None):
+        """
+        Return read_fn(path), reading it again only if the file changed. key identifies
+        the entry when several frames are derived from the same file (defaults to path).
+        """
+        key = key or path
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._pinned.get(key)
+            if entry is None:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+            if entry is not None and entry[0] == mtime:
+                metrics.count_cache("frame", hit=True)
+                return entry[1]
+        metrics.count_cache("frame", hit=False)
+
+        # Read outside the lock so that different files can be loaded concurrently
+        df = read_fn(path)
+
+        with self._lock:
+            # A pinned entry stays pinned when its file changes
+            if self._pinning or key in self._pinned:
+                self._entries.pop(key, None)
+                self._pinned[key] = (mtime, df)
+                return df
+            self._entries[key] = (mtime, df)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return df
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+
+FRAME_CACHE = FrameCache(max_entries=config.FRAME_CACHE_SIZE)
+
+
+def read_corpus_file(path, columns=None):
+    """
+    Read a processed corpus from TSV or Parquet, optionally only some columns. The string
+    columns are read as categoricals, like the dictionary-encoded Parquet columns, so that
+    each distinct value is stored once however many mentions repeat it.
+    """
+    if path.endswith(".parquet"):
+        # Dictionary-encoded columns come back as categoricals
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    return pd.read_csv(path, sep='\t', dtype=CORPUS_DTYPES, usecols=columns)
+
+
+def count_corpus_file(path):
+    """
+    Mention counts of a corpus file (see count_mentions). TSV files are read in chunks of
+    config.READ_CHUNK_SIZE mentions and the counts of each chunk are added to the running
+    counts, so that only the counts and one chunk are kept in memory.
+    """
+    if path.endswith(".parquet"):
+        return count_mentions(read_corpus_file(path, columns=REPORT_COLUMNS))
+    reader = pd.read_csv(path, sep='\t', dtype=CORPUS_DTYPES, usecols=REPORT_COLUMNS, chunksize=config.READ_CHUNK_SIZE)
+    df_counts = None
+    for chunk in reader:
+        df_chunk = count_mentions(chunk)
+        df_counts = df_chunk if df_counts is None else merge_aggregates([df_counts, df_chunk])
+    return df_counts
+
+
+def _read_tsv(path):
+    return pd.read_csv(path, sep='\t', dtype={'code': str})
+
+
+def _read_encoded(read_fn):
+    """Wrap a reader so that the cached frame carries the vocabulary ids of its codes."""
+    return lambda path: encode_codes(read_fn(path))
+
+
+def load_corpus(corpus, n_parents=0, columns=REPORT_COLUMNS):
+    """Corpus dataframe with the given columns (all of them if columns is None)."""
+    columns = list(columns) if columns is not None else None
+    return FRAME_CACHE.get(corpus_path(corpus, n_parents),
+                           _read_encoded(lambda path: read_corpus_file(path, columns=columns)),
+                           key=("corpus", corpus, n_parents, tuple(columns or ())))
+
+
+def load_counts(corpus):
+    """
+    Mention counts of a corpus with one row per (code, span, semantic_rel, label), which is all
+    the coverage report needs. The aggregate written by src/ingest.py is used when it exists,
+    otherwise the mentions are counted once per file version.
+    """
+    if counts_path(corpus) == aggregate_path(corpus):
+        return FRAME_CACHE.get(aggregate_path(corpus), _read_encoded(read_corpus_file), key=("counts", corpus))
+    return FRAME_CACHE.get(corpus_path(corpus),
+                           _read_encoded(count_corpus_file),
+                           key=("counts", corpus))
+
+
+def load_variables(project):
+    return FRAME_CACHE.get(variables_path(project), _read_encoded(_read_tsv))
+
+
+def _read_ancestors(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, memory_map=True)
+    return pd.read_csv(path, sep='\t', dtype={'code': str, 'ancestor': str})
+
+
+def _read_parent_lists(path):
+    """
+    Distinct (code, code_wp) rows of a parents corpus, deduplicated chunk by chunk for TSV files.
+    The chunks are parsed as plain strings: they are dropped right away, and categoricals of the
+    long code_wp lists are slower to build than they save.
+    """
+    if path.endswith(".parquet"):
+        return read_corpus_file(path, columns=["code", "code_wp"]).drop_duplicates(subset="code")
+    reader = pd.read_csv(path, sep='\t', dtype=str, usecols=["code", "code_wp"], chunksize=config.READ_CHUNK_SIZE)
+    df = pd.concat([chunk.drop_duplicates(subset="code") for chunk in reader], ignore_index=True)
+    return df.drop_duplicates(subset="code")
+
+
+def load_parents(corpus, n_parents):
+    """
+    Code -> parent table of a corpus with the parents up to n_parents levels above each code
+    (all of them for config.ALL_PARENTS), built once per file version.
+    """
+    path = parents_path(corpus, n_parents)
+    if path == ancestors_path(corpus):
+        def read_fn(path):
+            df_ancestors = FRAME_CACHE.get(path, _read_ancestors, key=("ancestors", corpus))
+            if n_parents != config.ALL_PARENTS:
+                df_ancestors = df_ancestors[df_ancestors["depth"] <= n_parents]
+            return explode_ancestors(df_ancestors)
+    else:
+        def read_fn(path):
+            return explode_parents(_read_parent_lists(path))
+
+    return FRAME_CACHE.get(path, read_fn, key=("parents", corpus, n_parents))
+
+
+def load_parent_lookup(project, corpus, n_parents):
+    """
+    Nearest variable ancestor of every code of a corpus for a project (see
+    resolve_parent_codes), computed once per (project, corpus, n_parents) and file versions.
+    """
+    var_mtime = os.stat(variables_path(project)).st_mtime_ns
+    return FRAME_CACHE.get(parents_path(corpus, n_parents),
+                           lambda path: resolve_parent_codes(load_parents(corpus, n_parents),
+                                                             load_variables(project)["code_id"].unique()),
+                           key=("parent_lookup", project, corpus, n_parents, var_mtime))
+
+
+def load_descendants(corpus, n_parents):
+    """
+    DescendantIndex of the codes of a corpus, from the same parents table as load_parents, so
+    that the subtree of a code holds the corpus codes up to n_parents levels below it.
+    """
+    return FRAME_CACHE.get(parents_path(corpus, n_parents),
+                           lambda path: DescendantIndex.from_parents(load_parents(corpus, n_parents)),
+                           key=("descendants", corpus, n_parents))
+
+
+_ONTOLOGY = None
+
+
+def load_ontology():
+    """SNOMED CT hierarchy of the config.ONTOLOGY_SNAPSHOT snapshot (None if not configured)."""
+    global _ONTOLOGY
+    if _ONTOLOGY is None and config.ONTOLOGY_SNAPSHOT:
+        _ONTOLOGY = SnomedCT.from_snapshot(config.ONTOLOGY_SNAPSHOT)
+    return _ONTOLOGY
+
+
+def preload(projects=config.ls_projects, corpora=config.ls_corpora, levels=config.PRELOAD_PARENTS):
+    """
+    Read the variables, corpus counts and parents tables (and the ontology, if configured)
+    ahead of the first request. Called in the gunicorn master so that the forked workers
+    share these frames instead of each reading its own copy. Missing files are skipped.
+    """
+    ls_loaded = []
+    # Pinned, so that the frames the workers read on their first requests do not evict them
+    with FRAME_CACHE.pinned():
+        for project in projects:
+            if os.path.exists(variables_path(project)):
+                ls_loaded.append(load_variables(project))
+        for corpus in corpora:
+            if not os.path.exists(counts_path(corpus)):
+                continue
+            ls_loaded.append(load_counts(corpus))
+            for n_parents in levels:
+                if n_parents != 0 and os.path.exists(parents_path(corpus, n_parents)):
+                    ls_loaded.append(load_parents(corpus, n_parents))
+
+    load_ontology()
+    return len(ls_loaded)
@@ -0,0 +1,220 @@
+import atexit
+import cProfile
+import math
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import diskcache
+
+import src.config as config
+
+# Upper bounds in seconds of the histogram buckets of the stage durations
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+# Measurements are added to running totals that never expire, exported as Prometheus counters,
+# and to per-minute slots that expire after the window, summed for the values of the last
+# METRICS_WINDOW seconds exported as gauges
+SLOT_SECONDS = 60
+TOTAL_KEY = ("total",)
+
+# Measurements of this process not yet added to the slots on disk, by slot
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+# Shared by the server workers and the background callback processes, opened on first use
+_metrics_cache = None
+_metrics_cache_lock = threading.Lock()
+
+
+def _get_metrics_cache():
+    global _metrics_cache
+    with _metrics_cache_lock:
+        if _metrics_cache is None:
+            _metrics_cache = diskcache.Cache(config.METRICS_DIR)
+        return _metrics_cache
+
+
+def _empty_slot():
+    return {"spans": {}, "caches": {}}
+
+
+def _merge(total, data):
+    """Add the histograms and cache counts of data to total."""
+    for stage, entry in data["spans"].items():
+        total_entry = total["spans"].setdefault(stage, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        total_entry["buckets"] = [a + b for a, b in zip(total_entry["buckets"], entry["buckets"])]
+        total_entry["sum"] += entry["sum"]
+        total_entry["count"] += entry["count"]
+    for cache_name, (hits, misses) in data["caches"].items():
+        counts = total["caches"].setdefault(cache_name, [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+
+
+def _update_slot(update_fn):
+    """Apply update_fn to the slot of this minute in memory, flushing to disk every METRICS_FLUSH_INTERVAL."""
+    slot = int(time.time() // SLOT_SECONDS)
+    with _pending_lock:
+        update_fn(_pending.setdefault(slot, _empty_slot()))
+        due = time.monotonic() - _last_flush >= config.METRICS_FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """Add the measurements of this process to the slots on disk shared by all processes."""
+    global _pending, _last_flush
+    with _pending_lock:
+        pending, _pending = _pending, {}
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+
+    metrics_cache = _get_metrics_cache()
+    with metrics_cache.transact():
+        total = metrics_cache.get(TOTAL_KEY) or _empty_slot()
+        for slot, entry in pending.items():
+            data = metrics_cache.get(("slot", slot)) or _empty_slot()
+            _merge(data, entry)
+            metrics_cache.set(("slot", slot), data, expire=config.METRICS_WINDOW + SLOT_SECONDS)
+            _merge(total, entry)
+        metrics_cache.set(TOTAL_KEY, total)
+
+
+def _after_fork_in_child():
+    # The parent flushed its measurements before forking, and the child opens its own connection
+    global _pending, _pending_lock, _metrics_cache, _metrics_cache_lock, _last_flush
+    _pending, _pending_lock, _last_flush = {}, threading.Lock(), time.monotonic()
+    _metrics_cache, _metrics_cache_lock = None, threading.Lock()
+
+
+os.register_at_fork(before=flush, after_in_child=_after_fork_in_child)
+# Processes that end with os._exit (pool and background job processes) call flush() themselves
+atexit.register(flush)
+
+
+def observe(stage, seconds):
+    """Add a duration of a stage to its histogram."""
+    def update_fn(data):
+        entry = data["spans"].setdefault(stage, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        entry["buckets"][next(i for i, bound in enumerate(BUCKETS) if seconds <= bound)] += 1
+        entry["sum"] += seconds
+        entry["count"] += 1
+    _update_slot(update_fn)
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as a stage of the report pipeline."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def count_cache(cache_name, hit):
+    """Count a hit or a miss of one of the caches."""
+    def update_fn(data):
+        data["caches"].setdefault(cache_name, [0, 0])[0 if hit else 1] += 1
+    _update_slot(update_fn)
+
+
+def collect(window=True):
+    """
+    Stage histograms and cache counts over the window, summed over the slots, or since the
+    metrics folder was created. The other processes add their measurements at most
+    METRICS_FLUSH_INTERVAL seconds late.
+    """
+    flush()
+    if not window:
+        total = _get_metrics_cache().get(TOTAL_KEY) or _empty_slot()
+        return total["spans"], total["caches"]
+
+    current = int(time.time() // SLOT_SECONDS)
+    total = _empty_slot()
+    for slot in range(current - config.METRICS_WINDOW // SLOT_SECONDS, current + 1):
+        data = _get_metrics_cache().get(("slot", slot))
+        if data is not None:
+            _merge(total, data)
+    return total["spans"], total["caches"]
+
+
+def render_prometheus():
+    """
+    Metrics in the Prometheus text exposition format. The histograms and cache lookups are
+    counters that only grow, so that rate() and histogram_quantile() apply; the values over
+    the last METRICS_WINDOW seconds are gauges.
+    """
+    spans, caches = collect(window=False)
+    lines = ["# HELP coverage_stage_seconds Duration of the report stages",
+             "# TYPE coverage_stage_seconds histogram"]
+    for stage, entry in sorted(spans.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, entry["buckets"]):
+            cumulative += count
+            le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+            lines.append(f'coverage_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'coverage_stage_seconds_sum{{stage="{stage}"}} {entry["sum"]:.6f}')
+        lines.append(f'coverage_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+
+    lines += ["# HELP coverage_cache_requests_total Cache lookups",
+              "# TYPE coverage_cache_requests_total counter"]
+    for cache_name, (hits, misses) in sorted(caches.items()):
+        lines.append(f'coverage_cache_requests_total{{cache="{cache_name}",result="hit"}} {hits}')
+        lines.append(f'coverage_cache_requests_total{{cache="{cache_name}",result="miss"}} {misses}')
+
+    window_spans, window_caches = collect()
+    lines += [f"# HELP coverage_stage_window_seconds_avg Mean duration of the report stages over the last "
+              f"{config.METRICS_WINDOW} seconds",
+              "# TYPE coverage_stage_window_seconds_avg gauge"]
+    for stage, entry in sorted(window_spans.items()):
+        lines.append(f'coverage_stage_window_seconds_avg{{stage="{stage}"}} {entry["sum"] / entry["count"]:.6f}')
+
+    lines += [f"# HELP coverage_cache_window_requests Cache lookups over the last {config.METRICS_WINDOW} seconds",
+              "# TYPE coverage_cache_window_requests gauge"]
+    for cache_name, (hits, misses) in sorted(window_caches.items()):
+        lines.append(f'coverage_cache_window_requests{{cache="{cache_name}",result="hit"}} {hits}')
+        lines.append(f'coverage_cache_window_requests{{cache="{cache_name}",result="miss"}} {misses}')
+
+    lines += [f"# HELP coverage_cache_window_hit_ratio Share of the cache lookups over the last "
+              f"{config.METRICS_WINDOW} seconds that were hits",
+              "# TYPE coverage_cache_window_hit_ratio gauge"]
+    for cache_name, (hits, misses) in sorted(window_caches.items()):
+        lines.append(f'coverage_cache_window_hit_ratio{{cache="{cache_name}"}} {hits / (hits + misses):.4f}')
+    return "\n".join(lines) + "\n"
+
+
+def start_profile():
+    """Start a cProfile capture if profiling is enabled (config.PROFILE_DIR), else return None."""
+    if not config.PROFILE_DIR:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, name):
+    """Stop a capture of start_profile and write its stats to PROFILE_DIR, returning the path."""
+    if profiler is None:
+        return None
+    profiler.disable()
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^\w.-]+", "_", name).strip("_")
+    path = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{name}.prof")
+    profiler.dump_stats(path)
+    return path
+
+
+@contextmanager
+def profile(name):
+    """Profile the enclosed block when profiling is enabled."""
+    profiler = start_profile()
+    try:
+        yield
+    finally:
+        stop_profile(profiler, name)
@@ -1,16 +1,30 @@
-import pandas as pd
+import csv
+import json
+import os
+import re
+from collections.abc import Mapping
+
 import numpy as np
-import scipy
-import matplotlib.pyplot as plt
-import networkx as nx
-from tqdm import tqdm
-import operator
+import pandas as pd
+
+from src.descendants import DescendantIndex
+from src.vocabulary import CodeVocabulary
 
+# Columns of the RF2 relationship file needed to build the hierarchy
+RF2_COLUMNS = {"id": "int64", "effectivetime": "int32", "active": "int8",
+               "sourceid": "int64", "destinationid": "int64", "typeid": "int64"}
+
+# Compiled snapshot file: magic, header length, JSON header and the arrays aligned to 64 bytes
+SNAPSHOT_MAGIC = b"SCTSNAP1"
+SNAPSHOT_ALIGN = 64
+# Arrays of the hierarchy stored in the snapshots
+SNAPSHOT_ARRAYS = ["parent_indptr", "parent_indices", "child_indptr", "child_indices",
+                   "ancestor_indptr", "ancestor_indices", "ancestor_depths"]
 
 
 class SnomedCT:
 
-    def __init__(self, file_name_rel, root_concept_code="138875005", relation_types = ["116680003"]) -> None:
+    def __init__(self, file_name_rel, root_concept_code="138875005", relation_types = ["116680003"], chunksize=1_000_000) -> None:
         """
             Args:
         file_name_rel (str): Path to the SnomedCT Relationship file in RF2 format
@@ -19,125 +33,270 @@ class SnomedCT:
                                         "Pharmaceutical / biologic product" we would use the code
                                         "373873005", if we want the whole snomed ontology we would
                                         use the code "138875005").Defaults to "138875005".
-        relation_types (str, optional): Type of relationship to consider when building the ontology.
-                                        Use string "116680003" if you only want to consider "Is a"
-                                        relationships, use "all" if you want to consider all types
-                                        of relationships (including concept model attributes).Defaults to "116680003".
-        self.root_concept_code = root_concept_code
-        self.relation_types = relation_types
-        self.file_name_rel = file_name_rel
-        
-        self._load()
+        relation_types (list, optional): Types of relationship to consider when building the ontology.
+                                        Use ["116680003"] if you only want to consider "Is a"
+                                        relationships. Defaults to ["116680003"].
+        chunksize (int, optional): Number of lines of the relationship file parsed at a time.
         """
 
         self.file_name_rel = file_name_rel
         self.root_concept_code = root_concept_code
         self.relation_types = relation_types
 
-        self.ontology = self._load_ontology()
-        self.rel_active = self._get_active_relations()
+        # Concepts are handled as dense integer ids, codes are only decoded for the results
+        self.vocab = CodeVocabulary([root_concept_code])
+
+        source_ids, destination_ids = self._read_active_relations(chunksize)
+        self._build_hierarchy(source_ids, destination_ids)
+        print("Se han obtenido {} relaciones del archivo".format(len(self.rel_active)))
 
-    def _load_ontology(self):
+    @classmethod
+    def open(cls, file_name_rel, snapshot_dir, root_concept_code="138875005", relation_types=["116680003"],
+             ancestor_index=True):
         """
-        Function to load SnomecCT relationships from RF2 format to netowrkx model.
+        Load the ontology from its compiled snapshot in snapshot_dir, parsing the RF2 file and
+        writing the snapshot first if it does not exist yet. With ancestor_index the snapshot
+        also stores the transitive closure (see build_ancestor_index).
+        """
+        path = os.path.join(snapshot_dir, snapshot_name(file_name_rel, relation_types))
+        if os.path.exists(path):
+            sct = cls.from_snapshot(path)
+            if not ancestor_index or sct.has_ancestor_index:
+                return sct
+
+        sct = cls(file_name_rel, root_concept_code=root_concept_code, relation_types=relation_types)
+        if ancestor_index:
+            sct.build_ancestor_index()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        sct.save_snapshot(path)
+        return sct
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Load a snapshot written by save_snapshot. The arrays are memory mapped read-only, so
+        processes opening the same snapshot share its pages.
+        """
+        meta, arrays = _read_snapshot(path)
+
+        sct = cls.__new__(cls)
+        sct.file_name_rel = meta["file_name_rel"]
+        sct.root_concept_code = meta["root_concept_code"]
+        sct.relation_types = meta["relation_types"]
+        sct.vocab = CodeVocabulary(arrays.pop("codes").astype(str))
+        for name, array in arrays.items():
+            setattr(sct, name, array)
+        return sct
+
+    def save_snapshot(self, path):
+        """Write the vocabulary and the CSR arrays of the hierarchy to a single binary file."""
+        meta = {
+            "file_name_rel": self.file_name_rel,
+            "release": release_version(self.file_name_rel),
+            "root_concept_code": self.root_concept_code,
+            "relation_types": list(self.relation_types),
+        }
+        arrays = {"codes": self.vocab.codes.astype(bytes)}
+        arrays.update({name: getattr(self, name) for name in SNAPSHOT_ARRAYS if hasattr(self, name)})
+        _write_snapshot(path, meta, arrays)
+
+    def _read_active_relations(self, chunksize):
+        """
+        Stream the RF2 relationship file in chunks keeping only the relations of the selected types.
+
+        A Full release contains every version of each relationship, so the row with the latest
+        effectiveTime of each relationship id decides whether it is active. Only the selected
+        types are kept between chunks, which bounds the memory far below the file size.
 
         Returns:
-            Networkx DiGraph: SnomedCT model in a NetworkxDigraph format.
-        
-        This code is based on the one written by @emreg00 (https://github.com/emreg00/toolbox/blob/master/parse_snomedct.py)
-        """
-        ontology = nx.MultiDiGraph()
-        f = open(self.file_name_rel)
-        header = f.readline().strip("\n")
-        col_to_idx = dict((val.lower(), i) for i, val in enumerate(header.split("\t")))
-        ontology.add_node("138875005")
-        for line in f:
-            words = line.strip("\n").split("\t")
-            #if relation_types == "116680003": #"Is a" relationship code
-            
-            if (words[col_to_idx["typeid"]] in self.relation_types) & (words[col_to_idx["active"]] == "0"):
-                source_id = words[col_to_idx["sourceid"]]
-                target_id = words[col_to_idx["destinationid"]]
-                try:
-                    ontology.remove_edge(target_id, source_id,key=words[col_to_idx["id"]])
-                except:
-                    print("Removing an already removed relation id {}".format(words[col_to_idx["id"]]))
-            elif (words[col_to_idx["typeid"]] in self.relation_types) & (words[col_to_idx["active"]] == "1"):
-                source_id = words[col_to_idx["sourceid"]]
-                target_id = words[col_to_idx["destinationid"]]
-                ontology.add_node(source_id)
-                ontology.add_edge(target_id, source_id,key=words[col_to_idx["id"]])
-                #print("Add the edge {} - {} key {}".format(target_id, source_id,words[col_to_idx["id"]]))
-            
-            #else: # All
-            #    source_id = words[col_to_idx["sourceid"]]
-            #    target_id = words[col_to_idx["destinationid"]]
-            #    ontology.add_edge(target_id, source_id)
-        #ontology = nx.dfs_tree(ontology, root_concept_code)
-        return ontology
-    
+            (sourceId, destinationId) int64 arrays of the active relations.
+        """
+        relation_types = [int(t) for t in self.relation_types]
+        reader = pd.read_csv(self.file_name_rel, sep="\t", quoting=csv.QUOTE_NONE,
+                             usecols=lambda col: col.lower() in RF2_COLUMNS,
+                             dtype={col: dtype for col, dtype in RF2_COLUMNS.items()},
+                             chunksize=chunksize)
 
-    def _get_active_relations(self, active_codes_lst=[]):
-        """
-        Leemos el archivo de relaciones de  snomed línea por línea, borrando aquellas relaciones
-        no activas. Posteriormente eliminamos del diccionario resultante las claves (sct codes)
-        que hay que borrar por pertenecer a conceptos inactivos. Por último, iteramos para conseguir
-        la forma final del diccionario  "CODIGO" --> "Lista de codigos padre".
-        """
-        file = open(self.file_name_rel, 'r')
-        lines = file.readlines()
-        rels_dict = dict()
-        # First round to get the active relationship
-        for index in tqdm(range(0, len(lines))):
-            if index == 0:
-                continue
-            else:  
-                elementos = lines[index].split("\t")
-                # Si la relación es de tipo is-a
-                if (elementos[7] == "116680003"):
-                    if elementos[4] in rels_dict.keys():
-                    # Si la relaciónIf relation ya ha sido guardado, pero es inactiva, cambiamos estado  
-                        if elementos[2] =="1":
-                            rels_dict[elementos[4]].append((elementos[5],"1"))
-                        else:
-                            try:
-                            # Si el valor active pasa a 0, borramos el elemento que tenia ese valor
-                                rels_dict[elementos[4]].remove((elementos[5],"1"))
-                            except:
-                                print("WARNING: Trying to remove key {} from dict. The element was removed before".format(elementos[4]))
-                    else:
-                        if elementos[2] =="1":
-                            rels_dict[elementos[4]] = [(elementos[5],"1")] 
-                        else: # No guardamos cosas inactivas.
-                            continue
-
-        print("Se han obtenido {} relaciones del archivo".format(len(rels_dict)))
-        # Una vez hecho, calculamos las claves que hay que eliminar (la diferencia 
-        # entre las claves del diccinario y los codigos activs) y las eliminamos
-        # del diccionario.
-        #keys_to_remove = set(rels_dict.keys()) - set(active_codes_lst)
-        #for key in keys_to_remove:
-        #    rels_dict.pop(key, None)
-        #print("Después de filtrar conceptos no activos quedan {} relaciones".format(len(rels_dict)))
-        # Por último, cogemos el primer elemento de cada una d elas listas de los values del dict.
-        rels_dict_final = {k: list(map(operator.itemgetter(0), v)) for k, v in rels_dict.items()}
-        
-        return rels_dict_final
-    
-    def get_parents(self, code, levels=1):
-        """ Funcion recursiva que obtiene una lista de códigos padres de un código dado. 
-        Se puede especificar el número de niveles por los que subirá en la ontología para
-        obtener los padres.    
+        latest = None
+        for chunk in reader:
+            chunk.columns = chunk.columns.str.lower()
+            chunk = chunk.loc[chunk["typeid"].isin(relation_types), ["id", "effectivetime", "active", "sourceid", "destinationid"]]
+            latest = chunk if latest is None else pd.concat([latest, chunk], ignore_index=True)
+            latest = latest.sort_values(["id", "effectivetime"], kind="stable").drop_duplicates("id", keep="last")
+
+        if latest is None:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        # The same pair can be related by several relationship ids (e.g. different groups)
+        edges = latest.loc[latest["active"] == 1, ["sourceid", "destinationid"]].drop_duplicates()
+        return edges["sourceid"].to_numpy(), edges["destinationid"].to_numpy()
+
+    def _build_hierarchy(self, source_ids, destination_ids):
+        """
+        Encode the relations with the vocabulary and store them as CSR adjacency arrays: the
+        parents of concept i are parent_indices[parent_indptr[i]:parent_indptr[i + 1]] and
+        the children child_indices[child_indptr[i]:child_indptr[i + 1]].
+        """
+        child_ids = self.vocab.encode(source_ids.astype(str))
+        parent_ids = self.vocab.encode(destination_ids.astype(str))
+
+        n_concepts = len(self.vocab)
+        self.parent_indptr, self.parent_indices = _to_csr(child_ids, parent_ids, n_concepts)
+        self.child_indptr, self.child_indices = _to_csr(parent_ids, child_ids, n_concepts)
+
+    def build_ancestor_index(self):
+        """
+        Precompute the transitive closure of the hierarchy with the distance to every ancestor.
+
+        The ancestors of concept i are ancestor_indices[ancestor_indptr[i]:ancestor_indptr[i + 1]],
+        sorted by id, and ancestor_depths holds the length of the shortest path to each of them.
+        Concepts are processed by generations (all their parents done before them), each one
+        with vectorized gathers of the parents' ancestors, so shared ancestors are merged once
+        per generation instead of being revisited along every path.
+        """
+        n_concepts = len(self.vocab)
+        n_pending = np.diff(self.parent_indptr)
+        generation = np.flatnonzero(n_pending == 0)
+
+        # Closure rows are accumulated in processing order and reordered by concept at the end
+        row_start = np.zeros(n_concepts, dtype=np.int64)
+        row_length = np.zeros(n_concepts, dtype=np.int64)
+        indices, depths = np.array([], dtype=np.int32), np.array([], dtype=np.int16)
+        size = 0
+        n_done = len(generation)
+
+        while len(generation):
+            generation_children = _neighbors(self.child_indptr, self.child_indices, generation)
+            n_pending -= np.bincount(generation_children, minlength=n_concepts)
+            next_generation = np.unique(generation_children[n_pending[generation_children] == 0])
+            if not len(next_generation):
+                break
+
+            # (concept, parent) pairs plus (concept, ancestor of the parent) pairs one step further
+            n_parents = self.parent_indptr[next_generation + 1] - self.parent_indptr[next_generation]
+            pair_concepts = np.repeat(next_generation, n_parents)
+            pair_parents = _neighbors(self.parent_indptr, self.parent_indices, next_generation)
+
+            inherited = _gather_rows(row_start, row_length, pair_parents)
+            concepts = np.concatenate([pair_concepts, np.repeat(pair_concepts, row_length[pair_parents])])
+            ancestors = np.concatenate([pair_parents, indices[inherited]])
+            ancestor_depths = np.concatenate([np.ones(len(pair_parents), dtype=np.int16), depths[inherited] + 1])
+
+            # Keep the shortest distance of each (concept, ancestor) pair, rows sorted by ancestor id
+            order = np.lexsort((ancestor_depths, ancestors, concepts))
+            concepts, ancestors, ancestor_depths = concepts[order], ancestors[order], ancestor_depths[order]
+            first = np.ones(len(concepts), dtype=bool)
+            first[1:] = (concepts[1:] != concepts[:-1]) | (ancestors[1:] != ancestors[:-1])
+            concepts, ancestors, ancestor_depths = concepts[first], ancestors[first], ancestor_depths[first]
+
+            counts = np.bincount(concepts, minlength=n_concepts)[next_generation]
+            row_start[next_generation] = size + np.cumsum(counts) - counts
+            row_length[next_generation] = counts
+            size += len(concepts)
+            indices = np.concatenate([indices, ancestors.astype(np.int32)])
+            depths = np.concatenate([depths, ancestor_depths])
+
+            n_done += len(next_generation)
+            generation = next_generation
+
+        if n_done < n_concepts:
+            print("WARNING: {} concepts are part of cycles and have no ancestors in the index".format(n_concepts - n_done))
+
+        self.ancestor_indptr = np.zeros(n_concepts + 1, dtype=np.int64)
+        np.cumsum(row_length, out=self.ancestor_indptr[1:])
+        positions = _gather_rows(row_start, row_length, np.arange(n_concepts))
+        self.ancestor_indices = indices[positions]
+        self.ancestor_depths = depths[positions]
+
+    @property
+    def has_ancestor_index(self):
+        return hasattr(self, "ancestor_indptr")
+
+    def descendant_index(self):
+        """DescendantIndex of the whole hierarchy, transposed once from the ancestor index."""
+        if getattr(self, "_descendant_index", None) is None:
+            self._descendant_index = DescendantIndex.from_ontology(self)
+        return self._descendant_index
+
+    def get_ancestors(self, code, max_depth=None):
+        """
+        Sorted codes of the ancestors of code up to max_depth levels above it (all of them
+        when max_depth is None), answered from the ancestor index.
         """
-        if levels == 0:
+        code_id = self.vocab.encode([code], add=False)[0]
+        if code_id < 0:
             return []
-        elif code in self.rel_active:
-            parents = []
-            for parent in self.rel_active[code]:
-                parents += [parent] + self.get_parents(parent, levels - 1)
-            return list(np.unique(parents))
+        start, end = self.ancestor_indptr[code_id], self.ancestor_indptr[code_id + 1]
+        ancestor_ids = self.ancestor_indices[start:end]
+        if max_depth is not None:
+            ancestor_ids = ancestor_ids[self.ancestor_depths[start:end] <= max_depth]
+        return sorted(self.vocab.decode(ancestor_ids).tolist())
+
+    def ancestor_depth(self, ancestor, code):
+        """
+        Length of the shortest is-a path from code up to ancestor, or None if ancestor is not
+        an ancestor of code. Binary search in the sorted ancestor row of code.
+        """
+        code_id, ancestor_id = self.vocab.encode([code, ancestor], add=False)
+        if code_id < 0 or ancestor_id < 0:
+            return None
+        start, end = self.ancestor_indptr[code_id], self.ancestor_indptr[code_id + 1]
+        position = start + np.searchsorted(self.ancestor_indices[start:end], ancestor_id)
+        if position < end and self.ancestor_indices[position] == ancestor_id:
+            return int(self.ancestor_depths[position])
+        return None
+
+    def is_ancestor(self, ancestor, code):
+        """Whether ancestor is an ancestor of code at any depth."""
+        return self.ancestor_depth(ancestor, code) is not None
+
+    def expand_ancestors(self, codes, max_depth=None):
+        """
+        Ancestors of many codes at once, as a columnar table with one row per (code, ancestor)
+        and the shortest distance between them in "depth". Repeated codes are expanded once and
+        unknown codes have no rows. Every depth up to max_depth (all when None) is returned in
+        the same pass, so callers can filter several levels from one table.
+        """
+        codes = pd.unique(np.asarray(codes, dtype=object))
+        code_ids = self.vocab.encode(codes, add=False)
+        codes, code_ids = codes[code_ids >= 0], code_ids[code_ids >= 0].astype(np.int64)
+
+        if self.has_ancestor_index:
+            row_length = np.diff(self.ancestor_indptr)
+            positions = _gather_rows(self.ancestor_indptr[:-1], row_length, code_ids)
+            sources = np.repeat(np.arange(len(code_ids)), row_length[code_ids])
+            ancestor_ids = self.ancestor_indices[positions]
+            depths = self.ancestor_depths[positions]
         else:
+            sources, ancestor_ids, depths = _expand_breadth_first(self.parent_indptr, self.parent_indices,
+                                                                  code_ids, max_depth)
+
+        if max_depth is not None:
+            keep = depths <= max_depth
+            sources, ancestor_ids, depths = sources[keep], ancestor_ids[keep], depths[keep]
+
+        return pd.DataFrame({"code": codes[sources],
+                             "ancestor": self.vocab.decode(ancestor_ids),
+                             "depth": depths.astype(np.int16)})
+
+    @property
+    def rel_active(self):
+        """Read-only "code" --> "list of parent codes" view of the active relations."""
+        return _DecodedRelations(self)
+
+    def get_parents(self, code, levels=1):
+        """ Obtiene la lista ordenada de códigos padres de un código dado.
+        Se puede especificar el número de niveles por los que subirá en la ontología para
+        obtener los padres (levels=None para todos los niveles).
+        """
+        if self.has_ancestor_index:
+            return self.get_ancestors(code, max_depth=levels)
+
+        code_id = self.vocab.encode([code], add=False)[0]
+        if code_id < 0:
             return []
+        ancestor_ids = _traverse(self.parent_indptr, self.parent_indices, code_id, levels)
+        return sorted(self.vocab.decode(ancestor_ids).tolist())
     
     def get_children(self, code):
         return self.subtree_code_list_with_deep(code, depth_limit=1)
@@ -145,23 +304,167 @@ class SnomedCT:
 
     def subtree_code_list_with_deep(self, code, depth_limit):
         """
-        Función en la que dado un código y un grafo de NetworkX, devuelve
-        la lista de códigos del subarbol que cuelga del código dado. 
+        Función que dado un código devuelve la lista de códigos del subarbol que cuelga
+        del código dado, hasta depth_limit niveles.
         
         Args:
-        ontology ([networkx.MultiDigraph]): ontologías calculada
         code ([str]): Código del que se quiere obtener la lista de códigos de su subarbol
         
-        Nota: También incluye el código de la entrada (code)
-        """
-        # Get sucesores
-        resultado_dict = nx.dfs_successors(self.ontology, source=code, depth_limit=depth_limit)
-        # Cogemos la lista de listas de conceptos 
-        lista_smallest_edges = [resultado_dict[i] for i in resultado_dict]
-        lista_smallest_edges_flatten = [item for sublist in lista_smallest_edges for item in sublist]
-        # Lista de hijos directos
-        lista_nodes = list(resultado_dict.keys())
-        # Unimos todo
-        lista_end = lista_smallest_edges_flatten + lista_nodes
-        # Devolmenos una lista de elementos únicos
-        return list(set(lista_end))
\ No newline at end of file
+        Nota: También incluye el código de la entrada (code) si tiene hijos
+        """
+        code_id = self.vocab.encode([code], add=False)[0]
+        if code_id < 0:
+            return []
+        if self.has_ancestor_index:
+            descendant_ids = np.sort(self.descendant_index().get_descendants(code_id, max_depth=depth_limit))
+        else:
+            descendant_ids = _traverse(self.child_indptr, self.child_indices, code_id, depth_limit)
+        if len(descendant_ids):
+            descendant_ids = np.append(descendant_ids, code_id)
+        return self.vocab.decode(descendant_ids).tolist()
+
+
+def release_version(file_name_rel):
+    """Release of an RF2 file name, e.g. "Full_INT_20240901" for sct2_Relationship_Full_INT_20240901.txt"""
+    name = os.path.splitext(os.path.basename(file_name_rel))[0]
+    match = re.match(r"sct2_\w+?_(\w+_\w+_\d{8})$", name)
+    return match.group(1) if match else name
+
+
+def snapshot_name(file_name_rel, relation_types):
+    """File name of the snapshot of a release built with the given relation types."""
+    return f"{release_version(file_name_rel)}_{'-'.join(sorted(relation_types))}.sctsnap"
+
+
+def _write_snapshot(path, meta, arrays):
+    header = dict(meta, arrays={})
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    # The header is padded with spaces so that the arrays start aligned right after it
+    header_bytes = json.dumps(header).encode()
+    prefix_size = len(SNAPSHOT_MAGIC) + 8
+    data_start = -(-(prefix_size + len(header_bytes)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header_bytes = header_bytes.ljust(data_start - prefix_size)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            array.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def _read_snapshot(path):
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a SnomedCT snapshot")
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    data_start = len(SNAPSHOT_MAGIC) + 8 + header_size
+
+    arrays = {}
+    for name, spec in header.pop("arrays").items():
+        shape = tuple(spec["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=spec["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec["dtype"], mode="r",
+                                     offset=data_start + spec["offset"], shape=shape)
+    return header, arrays
+
+
+def _to_csr(rows, cols, n):
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32)
+
+
+def _neighbors(indptr, indices, ids):
+    """Concatenated CSR rows of ids, gathered without a Python loop."""
+    starts = indptr[ids]
+    lengths = indptr[ids + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(lengths.sum())]
+
+
+def _gather_rows(row_start, row_length, ids):
+    """Positions of the rows of ids in a flat buffer where row i is [row_start[i], row_start[i] + row_length[i])."""
+    lengths = row_length[ids]
+    offsets = np.repeat(row_start[ids] - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def _expand_breadth_first(indptr, indices, code_ids, max_depth):
+    """
+    Multi-source breadth first search from all code_ids together. Returns (source position,
+    ancestor id, depth) arrays with the shortest depth of each pair.
+    """
+    n = len(indptr) - 1
+    sources = np.arange(len(code_ids))
+    nodes = code_ids
+    ls_sources, ls_nodes, ls_depths = [], [], []
+    seen = np.array([], dtype=np.int64)
+    depth = 0
+    while len(nodes) and (max_depth is None or depth < max_depth):
+        depth += 1
+        lengths = indptr[nodes + 1] - indptr[nodes]
+        sources = np.repeat(sources, lengths)
+        nodes = _neighbors(indptr, indices, nodes).astype(np.int64)
+
+        # Pairs are identified by source * n + node, only the first (shortest) visit is kept
+        keys, first = np.unique(sources * n + nodes, return_index=True)
+        new = ~np.isin(keys, seen)
+        sources, nodes = sources[first[new]], nodes[first[new]]
+        seen = np.union1d(seen, keys[new])
+
+        ls_sources.append(sources)
+        ls_nodes.append(nodes)
+        ls_depths.append(np.full(len(nodes), depth, dtype=np.int16))
+
+    if not ls_sources:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int16)
+    return np.concatenate(ls_sources), np.concatenate(ls_nodes), np.concatenate(ls_depths)
+
+
+def _traverse(indptr, indices, code_id, levels):
+    """Ids reachable from code_id in 1..levels steps (breadth first, each node visited once)."""
+    visited = np.array([], dtype=np.int32)
+    frontier = np.array([code_id], dtype=np.int64)
+    level = 0
+    while len(frontier) and (levels is None or level < levels):
+        frontier = np.setdiff1d(_neighbors(indptr, indices, frontier), visited)
+        visited = np.union1d(visited, frontier)
+        level += 1
+    return visited
+
+
+class _DecodedRelations(Mapping):
+    """Mapping of code strings to parent code strings backed by the CSR arrays."""
+
+    def __init__(self, sct):
+        self._sct = sct
+
+    def __getitem__(self, code):
+        code_id = self._sct.vocab.encode([code], add=False)[0]
+        if code_id < 0:
+            raise KeyError(code)
+        start, end = self._sct.parent_indptr[code_id], self._sct.parent_indptr[code_id + 1]
+        if start == end:
+            raise KeyError(code)
+        return self._sct.vocab.decode(self._sct.parent_indices[start:end]).tolist()
+
+    def __iter__(self):
+        has_parents = np.flatnonzero(np.diff(self._sct.parent_indptr))
+        return iter(self._sct.vocab.decode(has_parents).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self._sct.parent_indptr)))
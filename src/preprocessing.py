@@ -1,32 +1,72 @@
+import time
+
+import numpy as np
 import pandas as pd
-def generate_df_codes(df_data, df_vars, n_parents, debug=False):
 
-    # Make copies of the dataframes to avoid modifying the originals
-    df_data = df_data.copy()
-    df_vars = df_vars.copy()
+import src.metrics as metrics
+from src.vocabulary import VOCAB
+
+# Mention columns the coverage report depends on, mentions are counted by them
+AGGREGATE_KEYS = ["code", "span", "semantic_rel", "label"]
+
+
+def generate_df_codes(df_data, df_vars, n_parents, df_parents=None, df_parent_lookup=None, debug=False):
+
+    # The input frames can be shared with the loader caches, they are never modified: the
+    # parents are taken from the mentions first, then the work is done on a new narrow frame
+    if n_parents != 0 and df_parents is None and df_parent_lookup is None:
+        if n_parents != 1:
+            raise ValueError(f"The parent lists of the mentions give the depth of 1 parent only, "
+                             f"{n_parents} parents need df_parents from the ancestor table")
+        df_parents = explode_parents(df_data)
 
-    df_data = process_composites(df_data, df_vars)
+    # Each row is a single mention unless the corpus comes with aggregated counts, mentions are
+    # counted first so that the rest runs on one row per distinct mention
+    if "count" not in df_data.columns:
+        df_data = count_mentions(df_data)
+    df_data = df_data[[col for col in AGGREGATE_KEYS + ["count", "code_id"] if col in df_data.columns]]
+
+    # Categorical columns are decoded on the counts, codes and relations are rewritten below
+    df_data = df_data.astype({col: object for col in df_data.select_dtypes("category").columns})
+
+    # Codes are joined through their integer ids in the shared vocabulary
+    df_data = encode_codes(df_data)
+    df_vars = encode_codes(df_vars)
+
+    # Keep the annotated code, the parents table is indexed by it and composites are replaced below
+    df_data["code_src_id"] = df_data["code_id"]
+    with metrics.span("composites"):
+        df_data = process_composites(df_data, df_vars)
 
     df_data.rename(columns={"label": "label_corpus"}, inplace=True)
+    df_data["distance"] = 0
 
-    # If parents are used, then the code is replaced by the first parent code in the list
-    # NOTE: Other option could be to find the parent with higher match but this is not implemented
-    if n_parents > 0:
-        ls_found_codes = list(set(df_data["code"].unique()).intersection(set(df_vars["code"].unique())))
-        var_codes = df_vars["code"].unique()
+    # If parents are used, then the code is replaced by its nearest ancestor that is a variable
+    start = time.perf_counter()
+    if n_parents != 0:
+        var_ids = df_vars["code_id"].unique()
+        ls_found_codes = np.intersect1d(df_data["code_id"].unique(), var_ids)
 
         print(f"Found {len(ls_found_codes)} codes in the data")
-        df_data["parent"] = df_data["code_wp"].apply(lambda x: set(eval(x)).intersection(set(var_codes)))
-        df_data["parent_matches"] = df_data["parent"].apply(lambda x: len(x))
-        df_data.loc[(df_data["parent_matches"] > 0)&(~df_data["code"].isin(var_codes)), "semantic_rel"] = "PARENT"
-        df_data.loc[(df_data["parent_matches"] > 0)&(~df_data["code"].isin(var_codes)), "code"] = df_data.loc[(df_data["parent_matches"] > 0)&(~df_data["code"].isin(var_codes)), "parent"].apply(lambda x: next(iter(x)))
+        if df_parent_lookup is None:
+            df_parent_lookup = resolve_parent_codes(df_parents, var_ids)
+        df_parent_lookup = df_parent_lookup.set_index("code_id")
+
+        mask = (~df_data["code_id"].isin(var_ids)) & df_data["code_src_id"].isin(df_parent_lookup.index)
+        df_data.loc[mask, "semantic_rel"] = "PARENT"
+        df_data.loc[mask, "code_id"] = df_data.loc[mask, "code_src_id"].map(df_parent_lookup["parent_id"])
+        df_data.loc[mask, "distance"] = df_data.loc[mask, "code_src_id"].map(df_parent_lookup["distance"])
+        metrics.observe("parents", time.perf_counter() - start)
 
 
-    df_code_ovr = df_vars[["ID", "name", "code", "term", "label"]].merge(
-                                                                df_data[['code', 'span', 'semantic_rel', "label_corpus"]].reset_index(), 
-                                                                on='code', 
+    start = time.perf_counter()
+    df_code_ovr = df_vars[["ID", "name", "code", "code_id", "term", "label"]].merge(
+                                                                df_data[['code_id', 'span', 'semantic_rel', "label_corpus", "count", "distance"]].reset_index(), 
+                                                                on='code_id', 
                                                                 how='left',
-                                                            ).fillna("NOT_FOUND")
+                                                            )
+    # The count and distance of variables not found stay empty
+    df_code_ovr = df_code_ovr.fillna({col: "NOT_FOUND" for col in df_code_ovr.columns if col not in ("count", "distance")})
 
 
     # mask_nf = df_code_ovr["label_corpus"] != "NOT_FOUND"
@@ -39,7 +79,10 @@ def generate_df_codes(df_data, df_vars, n_parents, debug=False):
     # assert (df_code_ovr["semantic_rel"] == "COMPOSITE").sum() > 0, "NO COMPOSITES FOUND"
 
     # Group by 'code', 'span', and 'semantic_rel', then count occurrences
-    df_code_ovr = df_code_ovr.groupby(['ID', 'name', 'code', 'span', 'term', 'semantic_rel', 'label', 'label_corpus']).size().reset_index(name='count').sort_values(by="count", ascending=False)
+    df_code_ovr = df_code_ovr.groupby(['ID', 'name', 'code', 'span', 'term', 'semantic_rel', 'label', 'label_corpus'])\
+                             .agg(count=("count", "sum"), distance=("distance", "min"))\
+                             .astype({"count": "int64"})\
+                             .reset_index().sort_values(by="count", ascending=False)
     # df_code_ovr = df_code_ovr.sort_values(by=['ID', 'name', 'span', 'term', 'semantic_rel', 'label', 'label_corpus', "count"], ascending=False)
     # df_code_count = df_code_ovr.drop_duplicates(subset=['ID', 'name', 'span', 'term', 'semantic_rel', 'label', 'label_corpus'])
 
@@ -47,7 +90,7 @@ def generate_df_codes(df_data, df_vars, n_parents, debug=False):
     df_code_ovr.loc[df_code_ovr.span == "NOT_FOUND", "count"] = 0
 
     # Rename columns for clarity
-    df_code_ovr.columns = ['ID', 'name', 'code', 'span', 'term', 'semantic_rel', 'label', 'label_corpus', 'count']
+    df_code_ovr.columns = ['ID', 'name', 'code', 'span', 'term', 'semantic_rel', 'label', 'label_corpus', 'count', 'distance']
 
     df_code_ovr["found"] = df_code_ovr["span"] != "NOT_FOUND"
 
@@ -60,6 +103,7 @@ def generate_df_codes(df_data, df_vars, n_parents, debug=False):
     df_code_rel = df_code_ovr.groupby(["ID", "semantic_rel"]).aggregate({"count":"sum"}).reset_index()
     df_code_rel = df_code_rel.pivot(index="ID", columns="semantic_rel", values="count").fillna(0).reset_index()
     df_code_ovr = df_code_ovr.merge(df_code_rel, on="ID").sort_values(by="count", ascending=False)
+    metrics.observe("aggregation", time.perf_counter() - start)
 
     if debug:
         # Print the shape of the resulting dataframe
@@ -77,28 +121,117 @@ def generate_df_codes(df_data, df_vars, n_parents, debug=False):
     return df_code_ovr
 
 
+def count_mentions(df):
+    """
+    Count the mentions of a dataframe by (code, span, semantic_rel, label). Categorical
+    columns stay categorical, codes are made strings once the rows are counted.
+    """
+    df_counts = df.groupby(AGGREGATE_KEYS, dropna=False, observed=True).size().reset_index(name="count")
+    if not isinstance(df_counts["code"].dtype, pd.CategoricalDtype):
+        df_counts["code"] = df_counts["code"].astype(str)
+    return df_counts
+
+
+def as_strings(column):
+    """
+    Values of a corpus column as strings. Categorical columns are decoded through their
+    categories, astype(str) would build a fixed-width unicode copy of every row first.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.astype(object)
+    return column.astype(str)
+
+
+def merge_aggregates(ls_aggregates):
+    """Sum the counts of several aggregates."""
+    df = pd.concat(ls_aggregates, ignore_index=True)
+    return df.groupby(AGGREGATE_KEYS, dropna=False, observed=True).aggregate({"count": "sum"}).reset_index()
+
+
 def process_composites(df, df_vars):
     '''
     Function to extract composite codes. Get the first code that is in the list of variables.
     '''
 
-    df_data = df.copy()
-    df_vars = df_vars.copy()
+    # Only the composite rows are rewritten, on their own frame; the input frames are not modified
+    is_composite = (df["semantic_rel"] == "COMPOSITE").to_numpy()
+    if not is_composite.any():
+        return df
 
     # Get the unique codes from the variables dataframe to process the composites
-    ls_var_codes = df_vars["code"].drop_duplicates().tolist()
+    var_ids = pd.Index(encode_codes(df_vars)["code_id"].drop_duplicates())
 
-    # Merge df_variables with df_symptemist on 'code', filling missing values with "NOT_FOUND"
-    df_data_comp = df_data[df_data["semantic_rel"] == "COMPOSITE"].copy()
-    df_data_comp["code_list"] = df_data_comp["code"].str.split("+")
-    df_data_comp["var_code"] = df_data_comp["code_list"].apply(lambda code: [c for c in code if c in ls_var_codes][0] if any(c in ls_var_codes for c in code) else code[0])
-    df_data_comp["var_code"] = df_data_comp["var_code"].astype(str)
-    df_data_comp.code = df_data_comp.var_code
+    df_data_comp = df[is_composite]
+    code_list = as_strings(df_data_comp["code"]).str.split("+")
 
-    # Process composites
-    df_data_no_comp = df_data[df_data["semantic_rel"] != "COMPOSITE"].copy()
+    # Explode the parts keeping the row position and pick the first part that is a variable,
+    # falling back to the first part of the composite
+    parts = pd.Series(code_list.to_numpy()).explode()
+    part_ids = pd.Series(VOCAB.encode(parts.to_numpy()), index=parts.index)
+    first_part = part_ids.groupby(level=0, sort=False).first()
+    first_var_part = part_ids[part_ids.isin(var_ids)].groupby(level=0, sort=False).first()
+    var_id = first_var_part.reindex(first_part.index).fillna(first_part).astype(np.int32)
+
+    df_data_comp = df_data_comp.assign(code=VOCAB.decode(var_id.to_numpy()).astype(str))
+    if "code_id" in df_data_comp.columns:
+        df_data_comp["code_id"] = var_id.to_numpy()
 
     # Once composites have a single code instead of a list, concatenate the dataframes
-    df_data = pd.concat([df_data_no_comp, df_data_comp], ignore_index=True)
+    return pd.concat([df[~is_composite], df_data_comp], ignore_index=True)
+
+
+def encode_codes(df):
+    '''
+    Add the integer "code_id" column of the shared vocabulary if it is missing.
+    '''
+    if "code_id" not in df.columns:
+        df = df.assign(code_id=VOCAB.encode(df["code"]))
+    return df
+
+
+def explode_parents(df):
+    '''
+    Build the code -> parent table, as (code_id, parent_id, depth) vocabulary ids, from the "code_wp"
+    column of a 1_parents corpus, either a native list column (Parquet) or stringified lists (TSV).
+    The strings are parsed with string operations (no eval) once per distinct code.
+    Every parent is at depth 1; deeper levels are read from the ancestor tables (explode_ancestors),
+    since the lists do not record the depth of each parent.
+    '''
+    df_codes = df[["code", "code_wp"]].drop_duplicates(subset="code")
+    parents = df_codes["code_wp"]
+    if len(parents) and isinstance(parents.iloc[0], str):
+        parents = parents.str.strip("[]").str.replace("'", "", regex=False).str.split(", ")
+
+    df_parents = pd.DataFrame({"code": as_strings(df_codes["code"]), "parent": parents}).explode("parent")
+    df_parents = df_parents[df_parents["parent"].notna() & (df_parents["parent"] != "")]
+
+    return pd.DataFrame({"code_id": VOCAB.encode(df_parents["code"]),
+                         "parent_id": VOCAB.encode(df_parents["parent"]),
+                         "depth": np.ones(len(df_parents), dtype=np.int16)})
+
+
+def explode_ancestors(df_ancestors):
+    '''
+    Build the code -> parent table, as (code_id, parent_id, depth) vocabulary ids, from an ancestor
+    table with one (code, ancestor, depth) row per pair.
+    '''
+    df_ancestors = df_ancestors.astype({"code": str, "ancestor": str})
+    return pd.DataFrame({"code_id": VOCAB.encode(df_ancestors["code"]),
+                         "parent_id": VOCAB.encode(df_ancestors["ancestor"]),
+                         "depth": df_ancestors["depth"].to_numpy(dtype=np.int16)})
+
+
+def resolve_parent_codes(df_parents, var_ids):
+    '''
+    Map each corpus code to its nearest ancestor that is a variable, returning a lookup table with
+    one (code_id, parent_id, distance) row per code that has one.
+    Ties at the same distance are broken by the lowest ancestor code (string order), which does
+    not depend on the vocabulary ids or on the hash seed, so results are stable across runs.
+    '''
+    df_matches = df_parents[df_parents["parent_id"].isin(var_ids)]
+    df_matches = df_matches.assign(parent=VOCAB.decode(df_matches["parent_id"].to_numpy()))
+    df_matches = df_matches.sort_values(["code_id", "depth", "parent"]).drop_duplicates(subset="code_id")
 
-    return df_data
+    return pd.DataFrame({"code_id": df_matches["code_id"].to_numpy(),
+                         "parent_id": df_matches["parent_id"].to_numpy(),
+                         "distance": df_matches["depth"].to_numpy()})
@@ -0,0 +1,292 @@
+import itertools
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+import src.loader as loader
+from src.coverage_matrix import corpus_code_counts, variable_counts
+from src.preprocessing import as_strings
+
+CANDIDATE_COLUMNS = ["ID", "name", "variable_code", "span", "code", "label", "corpus", "count", "score"]
+
+
+def normalize(text):
+    """Lowercase text without accents and punctuation, e.g. "Reacción  adversa," -> "reaccion adversa"."""
+    text = str(text).lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"[\W_]+", " ", text).strip()
+
+
+def trigrams(text):
+    """Distinct character trigrams of a normalized text, padded so that word starts count."""
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """
+    Inverted index from character trigrams to the documents (texts) containing them, stored as
+    CSR arrays. Queries are ranked by the Dice coefficient of their trigram sets, so that
+    misspellings, plurals and word order changes still match.
+    """
+
+    def __init__(self, texts):
+        grams = [trigrams(normalize(text)) for text in texts]
+        self.doc_sizes = np.array([len(doc_grams) for doc_grams in grams], dtype=np.int32)
+
+        self.gram_ids = {}
+        gram_column = np.array([self.gram_ids.setdefault(gram, len(self.gram_ids))
+                                for doc_grams in grams for gram in doc_grams], dtype=np.int32)
+        doc_column = np.repeat(np.arange(len(grams), dtype=np.int32), self.doc_sizes)
+        # Postings of trigram i are doc_ids[indptr[i]:indptr[i + 1]], in increasing document order
+        order = np.argsort(gram_column, kind="stable")
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(gram_column, minlength=len(self.gram_ids)))])
+        self.doc_ids = doc_column[order]
+
+    def __len__(self):
+        return len(self.doc_sizes)
+
+    def search(self, query, limit=10, min_score=0.3, mask=None):
+        """
+        Best documents for a query as (doc_ids, scores) arrays sorted by decreasing score.
+        mask optionally restricts the search to the documents where it is True.
+        """
+        query_grams = [self.gram_ids[gram] for gram in trigrams(normalize(query)) if gram in self.gram_ids]
+        n_query = len(trigrams(normalize(query)))
+        if not query_grams:
+            return np.array([], dtype=np.int32), np.array([], dtype=np.float64)
+
+        postings = np.concatenate([self.doc_ids[self.indptr[i]:self.indptr[i + 1]] for i in query_grams])
+        candidates, shared = np.unique(postings, return_counts=True)
+        scores = 2 * shared / (n_query + self.doc_sizes[candidates])
+
+        keep = scores >= min_score
+        if mask is not None:
+            keep &= mask[candidates]
+        candidates, scores = candidates[keep], scores[keep]
+        order = np.lexsort((candidates, -scores))[:limit]
+        return candidates[order], scores[order]
+
+    def search_many(self, queries, limit=10, min_score=0.3, mask=None, chunk_size=64):
+        """
+        search for several queries in one pass, as (query_ids, doc_ids, scores) arrays with the
+        results of each query in the order of search. The shared trigrams of chunk_size queries
+        and every document are counted at once with one bincount.
+        """
+        query_grams = [trigrams(normalize(query)) for query in queries]
+        n_query = np.array([len(grams) for grams in query_grams], dtype=np.int64)
+        gram_lists = [[self.gram_ids[gram] for gram in grams if gram in self.gram_ids] for grams in query_grams]
+
+        ls_results = []
+        for start in range(0, len(queries), chunk_size):
+            chunk = gram_lists[start:start + chunk_size]
+            gram_column = np.fromiter(itertools.chain.from_iterable(chunk), dtype=np.int64)
+            query_column = np.repeat(np.arange(len(chunk)), [len(grams) for grams in chunk])
+
+            # Documents of the postings of every (query, trigram) pair, counted by (query, document)
+            n_postings = self.indptr[gram_column + 1] - self.indptr[gram_column]
+            offsets = np.repeat(self.indptr[gram_column] - (np.cumsum(n_postings) - n_postings), n_postings)
+            doc_column = self.doc_ids[offsets + np.arange(n_postings.sum())]
+            shared = np.bincount(np.repeat(query_column, n_postings) * len(self) + doc_column)
+            query_ids, doc_ids = np.divmod(np.flatnonzero(shared), len(self))
+            shared = shared[query_ids * len(self) + doc_ids]
+
+            scores = 2 * shared / (n_query[start + query_ids] + self.doc_sizes[doc_ids])
+            keep = scores >= min_score
+            if mask is not None:
+                keep &= mask[doc_ids]
+            query_ids, doc_ids, scores = query_ids[keep], doc_ids[keep], scores[keep]
+
+            # Best limit documents of each query, by decreasing score then document
+            order = np.lexsort((doc_ids, -scores, query_ids))
+            query_ids, doc_ids, scores = query_ids[order], doc_ids[order], scores[order]
+            rank = np.arange(len(query_ids)) - np.searchsorted(query_ids, query_ids)
+            top = rank < limit
+            ls_results.append((query_ids[top] + start, doc_ids[top].astype(np.int32), scores[top]))
+
+        if not ls_results:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int32), np.array([], dtype=np.float64)
+        return tuple(np.concatenate(arrays) for arrays in zip(*ls_results))
+
+
+class CoverageSearch:
+    """
+    Search over the variables of the projects (names, SNOMED CT terms and the translations of
+    variables_trans.tsv) and over the distinct spans of the corpora.
+    """
+
+    def __init__(self, projects, corpora):
+        ls_variables = []
+        for project in projects:
+            df_vars = loader.load_variables(project)
+            labels = [df_vars.assign(text=df_vars["name"], lang="name"), df_vars.assign(text=df_vars["term"], lang="term")]
+            if os.path.exists(loader.translations_path(project)):
+                df_trans = pd.read_csv(loader.translations_path(project), sep='\t', dtype=str)
+                df_trans = df_trans.melt(id_vars="code", var_name="lang", value_name="text").dropna(subset=["text"])
+                labels.append(df_vars.drop(columns=["code_id"]).merge(df_trans, on="code"))
+            df_labels = pd.concat(labels, ignore_index=True)[["ID", "name", "code", "term", "lang", "text"]]
+            ls_variables.append(df_labels.assign(project=project))
+        self.variables = pd.concat(ls_variables, ignore_index=True) if ls_variables else \
+            pd.DataFrame(columns=["ID", "name", "code", "term", "lang", "text", "project"])
+        self.variables = self.variables[self.variables["text"].astype(str).str.strip() != ""].reset_index(drop=True)
+
+        # One document per distinct span, the mentions table keeps its codes and counts by corpus
+        ls_mentions = []
+        for corpus in corpora:
+            df = loader.load_counts(corpus)
+            counts = df["count"] if "count" in df.columns else 1
+            df = pd.DataFrame({"span": as_strings(df["span"]), "code": as_strings(df["code"]),
+                               "label": as_strings(df["label"]), "count": counts})
+            ls_mentions.append(df.groupby(["span", "code", "label"]).aggregate({"count": "sum"}).reset_index().assign(corpus=corpus))
+        self.mentions = pd.concat(ls_mentions, ignore_index=True) if ls_mentions else \
+            pd.DataFrame(columns=["span", "code", "label", "count", "corpus"])
+        # Spans differing only in case or accents are the same document. The mentions are sorted
+        # by span so that the rows of span i are mentions[mention_ptr[i]:mention_ptr[i + 1]]
+        raw_spans, raw_ids = np.unique(self.mentions["span"].to_numpy(dtype=object), return_inverse=True)
+        normalized = np.array([normalize(span) for span in raw_spans], dtype=object)[raw_ids]
+        self.spans, self.mentions["span_id"] = np.unique(normalized, return_inverse=True)
+        self.mentions = self.mentions.sort_values(["span_id", "count"], ascending=[True, False], kind="mergesort")\
+                                     .reset_index(drop=True)
+        self.mention_ptr = np.searchsorted(self.mentions["span_id"].to_numpy(), np.arange(len(self.spans) + 1))
+        self.corpus_masks = {}
+        for corpus, span_ids in self.mentions.groupby("corpus")["span_id"]:
+            self.corpus_masks[corpus] = np.zeros(len(self.spans), dtype=bool)
+            self.corpus_masks[corpus][span_ids.to_numpy()] = True
+        self._found_ids = {}
+        self._candidates = {}
+
+        self.variable_index = TrigramIndex(self.variables["text"].tolist())
+        self.span_index = TrigramIndex(self.spans.tolist())
+
+    def search_variables(self, query, limit=10, project=None):
+        """Variables with a name, term or translation matching the query, best label first."""
+        mask = (self.variables["project"] == project).to_numpy() if project else None
+        # Several labels of a variable can match, more are retrieved and the best one is kept
+        doc_ids, scores = self.variable_index.search(query, limit=limit * 5, mask=mask)
+        df = self.variables.iloc[doc_ids].assign(score=scores.round(3))
+        return df.drop_duplicates(subset=["project", "ID"]).head(limit)[["project", "ID", "name", "code", "lang", "text", "score"]]
+
+    def _span_ids(self, queries, limit, corpus=None):
+        """Best spans for any of the queries, each span scored by its best query."""
+        mask = self.corpus_masks.get(corpus, np.zeros(len(self.spans), dtype=bool)) if corpus else None
+        hits = [self.span_index.search(query, limit=limit, mask=mask) for query in queries]
+        span_ids = np.concatenate([hit[0] for hit in hits])
+        scores = np.concatenate([hit[1] for hit in hits])
+        order = np.lexsort((span_ids, -scores))
+        span_ids, first = np.unique(span_ids[order], return_index=True)
+        best = np.argsort(first, kind="stable")[:limit]
+        return span_ids[best], scores[order][first[best]]
+
+    def _mentions(self, span_ids, scores, corpus=None):
+        """Mention rows of the spans, with the score of their span."""
+        starts, ends = self.mention_ptr[span_ids], self.mention_ptr[span_ids + 1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.array([], dtype=np.int64)])
+        df = self.mentions.iloc[rows].assign(score=np.repeat(scores.round(3), ends - starts))
+        if corpus:
+            df = df[df["corpus"] == corpus]
+        return df[["span", "code", "label", "corpus", "count", "score"]].reset_index(drop=True)
+
+    def search_spans(self, query, limit=10, corpus=None):
+        """Mentions whose span matches the query, with their code, label and count by corpus."""
+        span_ids, scores = self._span_ids([query], limit, corpus)
+        return self._mentions(span_ids, scores, corpus)
+
+    def _parents_mtime(self, corpus, n_parents):
+        return os.stat(loader.parents_path(corpus, n_parents)).st_mtime_ns if n_parents != 0 else None
+
+    def found_ids(self, project, corpus, n_parents=0):
+        """IDs of the variables of project with mentions in corpus, kept until the parents table changes."""
+        parents_mtime = self._parents_mtime(corpus, n_parents)
+        key = (project, corpus, n_parents)
+        if key not in self._found_ids or self._found_ids[key][0] != parents_mtime:
+            df_vars = loader.load_variables(project)
+            df_parents = loader.load_parents(corpus, n_parents) if n_parents != 0 else None
+            df_counts = variable_counts(corpus_code_counts(corpus), df_vars, n_parents, df_parents)
+            self._found_ids[key] = (parents_mtime, set(df_counts["ID"]))
+        return self._found_ids[key][1]
+
+    def candidates(self, project, corpus, n_parents=0, ids=None, limit=5):
+        """
+        Candidate mentions of corpus for the variables of project without any match (NOT_FOUND),
+        the limit best spans for their name, term and translations. ids restricts the variables.
+        The candidates of all the variables with config.CANDIDATES_CACHE_LIMIT spans are kept
+        until the parents table changes, and smaller limits are cut from them.
+        """
+        if limit > config.CANDIDATES_CACHE_LIMIT:
+            df_candidates = self._find_candidates(project, corpus, n_parents, ids, limit)
+            return df_candidates[CANDIDATE_COLUMNS]
+
+        parents_mtime = self._parents_mtime(corpus, n_parents)
+        key = (project, corpus, n_parents)
+        if key not in self._candidates or self._candidates[key][0] != parents_mtime:
+            df_candidates = self._find_candidates(project, corpus, n_parents, None, config.CANDIDATES_CACHE_LIMIT)
+            self._candidates[key] = (parents_mtime, df_candidates)
+        df_candidates = self._candidates[key][1]
+
+        if ids is not None:
+            df_candidates = df_candidates[df_candidates["ID"].isin(ids)]
+        # The best spans of a variable for a smaller limit are the first ones of a larger limit
+        is_first = ~df_candidates.duplicated(subset=["ID", "span_id"])
+        df_candidates = df_candidates[is_first.groupby(df_candidates["ID"]).cumsum() <= limit]
+        return df_candidates[CANDIDATE_COLUMNS].reset_index(drop=True)
+
+    def _find_candidates(self, project, corpus, n_parents, ids, limit):
+        """Candidates with limit spans per variable, and the span_id of each row."""
+        found_ids = self.found_ids(project, corpus, n_parents)
+        df_labels = self.variables[(self.variables["project"] == project) & ~self.variables["ID"].isin(found_ids)]
+        if ids is not None:
+            df_labels = df_labels[df_labels["ID"].isin(ids)]
+        if df_labels.empty:
+            return pd.DataFrame(columns=CANDIDATE_COLUMNS + ["span_id"])
+
+        # All the labels are searched at once, each span of a variable is scored by its best label
+        texts = df_labels["text"].unique()
+        mask = self.corpus_masks.get(corpus, np.zeros(len(self.spans), dtype=bool))
+        query_ids, span_ids, scores = self.span_index.search_many(texts, limit=limit, mask=mask)
+        df_hits = pd.DataFrame({"text": texts[query_ids], "span_id": span_ids, "score": scores})
+        df_hits = df_labels[["ID", "text"]].drop_duplicates().merge(df_hits, on="text")
+        df_hits = df_hits.sort_values(["ID", "score", "span_id"], ascending=[True, False, True], kind="mergesort")\
+                         .drop_duplicates(subset=["ID", "span_id"]).groupby("ID", sort=False).head(limit)
+
+        # Mention rows of the spans of each variable, in the corpus
+        starts = self.mention_ptr[df_hits["span_id"].to_numpy()]
+        n_rows = self.mention_ptr[df_hits["span_id"].to_numpy() + 1] - starts
+        rows = np.repeat(starts - (np.cumsum(n_rows) - n_rows), n_rows) + np.arange(n_rows.sum())
+        df_variables = df_labels.drop_duplicates(subset="ID").set_index("ID")
+        var_ids = np.repeat(df_hits["ID"].to_numpy(), n_rows)
+        df_candidates = self.mentions.iloc[rows].assign(ID=var_ids,
+                                                        name=df_variables["name"].reindex(var_ids).to_numpy(),
+                                                        variable_code=df_variables["code"].reindex(var_ids).to_numpy(),
+                                                        score=np.repeat(df_hits["score"].to_numpy().round(3), n_rows))
+        df_candidates = df_candidates[df_candidates["corpus"] == corpus]
+        return df_candidates[CANDIDATE_COLUMNS + ["span_id"]].reset_index(drop=True)
+
+
+_SEARCH = None
+_SEARCH_LOCK = threading.Lock()
+
+
+def load_search(projects=config.ls_projects, corpora=config.ls_corpora):
+    """
+    CoverageSearch of the projects and corpora with data, built again only when one of the
+    variables, translations or corpus files changes.
+    """
+    global _SEARCH
+    projects = [project for project in projects if os.path.exists(loader.variables_path(project))]
+    corpora = [corpus for corpus in corpora if os.path.exists(loader.counts_path(corpus))]
+    paths = [loader.variables_path(project) for project in projects] + \
+            [loader.translations_path(project) for project in projects if os.path.exists(loader.translations_path(project))] + \
+            [loader.counts_path(corpus) for corpus in corpora]
+    stamp = tuple((path, os.stat(path).st_mtime_ns) for path in paths)
+
+    with _SEARCH_LOCK:
+        if _SEARCH is None or _SEARCH[0] != stamp:
+            _SEARCH = (stamp, CoverageSearch(projects, corpora))
+        return _SEARCH[1]
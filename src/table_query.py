@@ -0,0 +1,174 @@
+import math
+import operator as op
+import re
+
+import pandas as pd
+
+# DataTable filter operators as written in filter_query, e.g. {count_ID_total} >= 5 or {name} contains heart.
+# The word operators take an i (case insensitive) or s (case sensitive) prefix, e.g. icontains
+WORD_OPERATORS = ["ge", "le", "lt", "gt", "ne", "eq", "contains", "datestartswith"]
+OPERATORS = {">=": "ge", "<=": "le", "<": "lt", ">": "gt", "!=": "ne", "=": "eq",
+             **{f"{case}{word}": f"{case}{word}" for case in ("", "i", "s") for word in WORD_OPERATORS}}
+
+COMPARISONS = {'eq': op.eq, 'ne': op.ne, 'lt': op.lt, 'le': op.le, 'gt': op.gt, 'ge': op.ge}
+
+# A clause is the column in braces followed by the operator, so that operator words inside the
+# value (e.g. {name} contains "bone marrow") are not taken for the operator. Word operators need
+# a space after them, symbols are tried longest first
+FILTER_PART = re.compile(r"\s*\{(?P<name>[^}]*)\}\s*"
+                         r"(?P<operator>>=|<=|!=|<|>|=|[is]?(?:ge|le|lt|gt|ne|eq|contains|datestartswith)(?=\s))"
+                         r"(?P<value>.*)", re.DOTALL)
+
+
+def split_filter_part(filter_part):
+    """Split one clause of a DataTable filter_query into (column, operator, value)."""
+    match = FILTER_PART.match(filter_part)
+    if match is None:
+        return None, None, None
+
+    value_part = match.group("value").strip()
+    v0 = value_part[0] if value_part else ""
+    if v0 and len(value_part) > 1 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+        value = value_part[1: -1].replace('\\' + v0, v0)
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+
+    return match.group("name"), OPERATORS[match.group("operator")], value
+
+
+def split_case(operator):
+    """(operator, case_insensitive) of an operator of split_filter_part, e.g. icontains -> (contains, True)."""
+    if operator[:1] in ("i", "s") and operator[1:] in WORD_OPERATORS:
+        return operator[1:], operator[0] == "i"
+    return operator, False
+
+
+def number_text(value):
+    """A number as the DataTable shows it, 3.0 -> "3" and 0.25 -> "0.25"."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def filter_frame(df, filter_query):
+    """
+    Rows of df matching a DataTable filter_query (clauses joined with &&). A text value never
+    matches the numbers of a numeric column, so only ne keeps its rows. Raises ValueError for
+    clauses with an operator that is not supported, e.g. {name} is blank.
+    """
+    if not filter_query:
+        return df
+
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if operator is None:
+            raise ValueError(f"Unsupported filter {filter_part!r}")
+        if col_name not in df.columns:
+            continue
+
+        operator, case_insensitive = split_case(operator)
+        column = df[col_name]
+        numeric = pd.api.types.is_numeric_dtype(column)
+        if operator in COMPARISONS and numeric:
+            if isinstance(filter_value, float):
+                mask = getattr(column, operator)(filter_value)
+            else:
+                mask = pd.Series(operator == 'ne', index=df.index)
+        else:
+            # Text comparisons, numbers as shown in the table
+            filter_value = number_text(filter_value) if isinstance(filter_value, float) else str(filter_value)
+            column = column.map(number_text, na_action="ignore") if numeric else column
+            if case_insensitive:
+                column, filter_value = column.str.lower(), filter_value.lower()
+            if operator in COMPARISONS:
+                mask = getattr(column, operator)(filter_value)
+            elif operator == 'contains':
+                mask = column.astype(object).str.contains(filter_value, regex=False, na=False)
+            else:
+                mask = column.astype(object).str.startswith(filter_value, na=False)
+        df = df.loc[mask]
+    return df
+
+
+def sort_frame(df, sort_by):
+    """Sort df by a DataTable sort_by list, e.g. [{"column_id": "name", "direction": "asc"}]."""
+    if not sort_by:
+        return df
+    return df.sort_values([col["column_id"] for col in sort_by],
+                          ascending=[col["direction"] == "asc" for col in sort_by],
+                          kind="mergesort")
+
+
+def filter_records(records, filter_query, numeric_columns=()):
+    """
+    Records (dicts) matching a DataTable filter_query, like filter_frame without pandas.
+    numeric_columns are compared as numbers, the other columns as text. Missing values
+    (None) only match the ne operator.
+    """
+    if not filter_query:
+        return records
+
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if operator is None:
+            raise ValueError(f"Unsupported filter {filter_part!r}")
+        if not records or col_name not in records[0]:
+            continue
+
+        operator, case_insensitive = split_case(operator)
+        numeric = col_name in numeric_columns
+        if operator in COMPARISONS and numeric:
+            if isinstance(filter_value, float):
+                compare = COMPARISONS[operator]
+                records = [record for record in records
+                           if (operator == 'ne' if record[col_name] is None else compare(record[col_name], filter_value))]
+            elif operator != 'ne':
+                records = []
+            continue
+
+        def text(value):
+            value = number_text(value) if numeric else str(value)
+            return value.lower() if case_insensitive else value
+
+        filter_value = number_text(filter_value) if isinstance(filter_value, float) else str(filter_value)
+        filter_value = filter_value.lower() if case_insensitive else filter_value
+        if operator in COMPARISONS:
+            compare = COMPARISONS[operator]
+            records = [record for record in records
+                       if (operator == 'ne' if record[col_name] is None else compare(text(record[col_name]), filter_value))]
+        elif operator == 'contains':
+            records = [record for record in records
+                       if record[col_name] is not None and filter_value in text(record[col_name])]
+        else:
+            records = [record for record in records
+                       if record[col_name] is not None and text(record[col_name]).startswith(filter_value)]
+    return records
+
+
+def sort_records(records, sort_by):
+    """Sort records by a DataTable sort_by list like sort_frame, missing values (None) last."""
+    for col in reversed(sort_by or []):
+        present = [record for record in records if record[col["column_id"]] is not None]
+        missing = [record for record in records if record[col["column_id"]] is None]
+        records = sorted(present, key=op.itemgetter(col["column_id"]), reverse=col["direction"] != "asc") + missing
+    return records
+
+
+def query_records(records, filter_query, sort_by, page_current, page_size, numeric_columns=()):
+    """query_page on a list of records, e.g. a table composed from artifacts, without pandas."""
+    records = sort_records(filter_records(records, filter_query, numeric_columns), sort_by)
+    page_count = max(math.ceil(len(records) / page_size), 1)
+    return records[page_current * page_size: (page_current + 1) * page_size], page_count
+
+
+def query_page(df, filter_query, sort_by, page_current, page_size):
+    """
+    Page page_current of df after applying the filter and sort of a DataTable in custom mode.
+    Returns the page records and the number of pages.
+    """
+    df = sort_frame(filter_frame(df, filter_query), sort_by)
+    page_count = max(math.ceil(len(df) / page_size), 1)
+    df_page = df.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return df_page.to_dict('records'), page_count
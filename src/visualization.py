@@ -1,64 +1,139 @@
+import html
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 import plotly.express as px
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 
+from src.coverage_matrix import corpus_code_counts, variable_subtree_counts
 from src.preprocessing import generate_df_codes
-
-
-def generate_report_table(project, ls_corpora, n_parents):
-    df_report = pd.DataFrame()
-    ls_figures = []
-    ls_corpora = ls_corpora if isinstance(ls_corpora, list) else [ls_corpora]
+import src.config as config
+import src.loader as loader
+import src.cache as cache
+import src.metrics as metrics
+
+# Rows and metrics of the report table, with one column per metric and corpus
+REPORT_INDEX = ["ID", "name", "term", "label", "label_corpus"]
+REPORT_VALUES = ["count_ID", "count_subtree", "distance", "mentions", "ratio"]
+
+
+def generate_report_table(project, ls_corpora, n_parents, progress=None, max_workers=None, cached_only=False):
+    """
+    Coverage of a project in several corpora, one column per corpus and metric. The reports
+    missing from the result cache are computed concurrently on a pool of forked processes
+    (building the figures holds the GIL) and added to the cache of this process.
+    progress, if given, is called with a message each time a corpus is done. With cached_only,
+    None is returned instead of computing the missing reports.
+    """
+    ls_corpora = list(dict.fromkeys(ls_corpora)) if isinstance(ls_corpora, list) else [ls_corpora]
+    max_workers = max_workers or config.REPORT_WORKERS or os.cpu_count()
+
+    d_outputs = {}
     for corpus in ls_corpora:
-        _, output = report_corpus(project, corpus, show=False, n_parents=n_parents)
-        df_report_i = output[0]
-        figures = output[1:]
-        df_report_i["corpus"] = corpus
-        df_report = pd.concat([df_report, df_report_i])
+        result = cache.RESULT_CACHE.get(report_key(project, corpus, n_parents))
+        if result is not None:
+            d_outputs[corpus] = result[1]
+    ls_missing = [corpus for corpus in ls_corpora if corpus not in d_outputs]
+    if cached_only and ls_missing:
+        return None
+
+    def done(corpus, result):
+        d_outputs[corpus] = result[1]
+        if progress is not None:
+            progress(f"Computed the coverage of {corpus} ({len(d_outputs)}/{len(ls_corpora)})")
+
+    if min(max_workers, len(ls_missing)) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(ls_missing)),
+                                 mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {executor.submit(_report_corpus_process, project, corpus, n_parents): corpus
+                       for corpus in ls_missing}
+            for future in as_completed(futures):
+                corpus = futures[future]
+                cache.RESULT_CACHE.set(report_key(project, corpus, n_parents), future.result())
+                done(corpus, future.result())
+    else:
+        for corpus in ls_missing:
+            done(corpus, report_corpus(project, corpus, n_parents=n_parents, show=False))
 
-        ls_figures.extend(figures)
+    # Results are shared through the cache, so the corpus column is added on a new frame
+    df_report = pd.concat([d_outputs[corpus][0].assign(corpus=corpus) for corpus in ls_corpora])
+    ls_figures = [fig for corpus in ls_corpora for fig in d_outputs[corpus][1:]]
 
     # print(df_report.head())
     # show the count_ID, total_mentions and total_ratio for each corpus using ID as index
-    df_out = df_report.pivot(index=["ID", "name", "term", "label", "label_corpus"], columns="corpus", values=["count_ID", "mentions", "ratio"])
+    df_out = df_report.pivot(index=REPORT_INDEX, columns="corpus", values=REPORT_VALUES)
     # print(df_out.head())
     df_out.columns = [f"{col}_{sub}" for col, sub in df_out.columns]
-    df_out = df_out.sort_values(by=list(df_out.columns)[0], ascending=False)
+    # Stable sort, so that the tables composed from artifacts (artifacts.compose_table) have the same order
+    df_out = df_out.sort_values(by=list(df_out.columns)[0], ascending=False, kind="mergesort")
 
     df_out = df_out.reset_index()
 
     return df_out, ls_figures
 
-def report_corpus(project, corpus, n_parents, show=True, debug=False):
-    if n_parents == 0:
-        DATA = f'data/processed/{corpus}.tsv'
-        # print(DATA)
-    else:
-        DATA = f'data/processed/{n_parents}_parents/{corpus}.tsv'
-
-    DATA_VAR = f'data/variables/{project}/processed/variables.tsv'
+def _report_corpus_process(project, corpus, n_parents):
+    """report_corpus in a pool process, which exits without running the atexit flush of the metrics."""
+    try:
+        return report_corpus(project, corpus, n_parents=n_parents, show=False)
+    finally:
+        metrics.flush()
 
-    print(f"Loading data from {DATA}")
-    df_data = pd.read_csv(DATA, sep='\t', dtype={'code': str})
-    df_var = pd.read_csv(DATA_VAR, sep='\t', dtype={'code': str})
+def report_key(project, corpus, n_parents):
+    return cache.make_key(project, corpus, n_parents, loader.report_inputs(project, corpus, n_parents))
 
-    df_code_ovr = generate_df_codes(df_data=df_data, df_vars=df_var, n_parents=n_parents, debug=debug)
-
-    output = plot_code_distribution(df_code_ovr, corpus=corpus, show=show)
+def report_corpus(project, corpus, n_parents, show=True, debug=False):
+    inputs = loader.report_inputs(project, corpus, n_parents)
+    key = cache.make_key(project, corpus, n_parents, inputs)
+
+    # Debug runs always recompute so that the intermediate prints are shown
+    result = None if debug else cache.RESULT_CACHE.get(key)
+    if result is None:
+        print(f"Loading data from {inputs[0]}")
+        with metrics.span("load"):
+            df_data = loader.load_counts(corpus)
+            df_var = loader.load_variables(project)
+
+            df_parent_lookup = loader.load_parent_lookup(project, corpus, n_parents) if n_parents != 0 else None
+
+        df_code_ovr = generate_df_codes(df_data=df_data, df_vars=df_var, n_parents=n_parents,
+                                        df_parent_lookup=df_parent_lookup, debug=debug)
+
+        with metrics.span("figures"):
+            output = plot_code_distribution(df_code_ovr, corpus=corpus, show=False)
+
+        # Mentions anywhere in the subtree of each variable, including those of more specific variables
+        with metrics.span("subtree"):
+            descendant_index = loader.load_descendants(corpus, n_parents) if n_parents != 0 else None
+            df_subtree = variable_subtree_counts(corpus_code_counts(corpus), df_var, n_parents, descendant_index)
+            df_report = output[0]
+            df_report.insert(df_report.columns.get_loc("count_ID") + 1, "count_subtree",
+                             df_report["ID"].map(df_subtree.set_index("ID")["count"]).fillna(0).astype("int64"))
+        result = (df_code_ovr, output)
+        cache.RESULT_CACHE.set(key, result)
+
+    df_code_ovr, output = result
+    if show:
+        for fig in output[1:]:
+            fig.show()
     return df_code_ovr, output
 
-def plot_code_distribution(df, corpus, show=True):
+def plot_code_distribution(df, corpus, show=True, light=None):
+    """
+    Report table and figures of a corpus. In light mode (config.LIGHT_FIGURES by default) the
+    bar charts by semantic relationship and span are built with bar_chart instead of plotly express.
+    """
+    light = config.LIGHT_FIGURES if light is None else light
 
    #### Variables ####
     color_sequence = [ '#1EE132', '#9E8C88']
 
     #### Data Preparation for Visualization ####
-    # Filter the dataframe to exclude rows where 'span' is "NOT_FOUND"
-    df = df.copy()
-    # print(df.head())
     # Create a new column with the ID, name, and term concatenated for better visualization
-    df["ID+term"] = df["ID"] + "-" + df["name"] + " (" + df["term"] + ")"
+    # (on a new frame, df can be a cached result)
+    df = df.assign(**{"ID+term": df["ID"] + "-" + df["name"] + " (" + df["term"] + ")"})
 
     # Dataframe to plot the distribution of found variables by semantic tag
     df_sem_tag = df.drop_duplicates(subset=["ID", "label", "found"]).copy()
@@ -155,11 +230,16 @@ def plot_code_distribution(df, corpus, show=True):
     n_terms = df_found["ID+term"].nunique()
     n_show = 25
 
-    fig1 = px.bar(df_count_rel.sort_values(by="count_ID", ascending=True),
-                y='ID+term', x='count', color='semantic_rel', 
-                title=f'Codes by Semantic Relationship [Variable Name (SNOMED term)] <Zoom {n_show} out of {n_terms} terms; zoom out to see all>',
-                labels={'count': 'Count', 'ID+term': 'Name'},
-                orientation='h')
+    title1 = f'Codes by Semantic Relationship [Variable Name (SNOMED term)] <Zoom {n_show} out of {n_terms} terms; zoom out to see all>'
+    if light:
+        fig1 = bar_chart(df_count_rel.sort_values(by="count_ID", ascending=True),
+                         y='ID+term', x='count', color='semantic_rel', title=title1, labels={'count': 'Count', 'ID+term': 'Name'})
+    else:
+        fig1 = px.bar(df_count_rel.sort_values(by="count_ID", ascending=True),
+                    y='ID+term', x='count', color='semantic_rel', 
+                    title=title1,
+                    labels={'count': 'Count', 'ID+term': 'Name'},
+                    orientation='h')
     
     fig1.update_layout(
                            height=600,
@@ -173,10 +253,17 @@ def plot_code_distribution(df, corpus, show=True):
     # Create a bar chart for all the found codes by count
     # print(df_found.sort_values(by="count_total", ascending=False).head(50))
 
-    fig2 = px.bar(df_found.drop_duplicates(subset=["ID", "span", "count_ID"]).sort_values(by="count_ID", ascending=True),
-                y='ID+term', x='count', color='span', title=f'Codes Distribution [Variable Name (SNOMED term)] <Zoom {n_show} out of {n_terms} terms; zoom out to see all>',
-                labels={'count_total': 'Count', 'ID+term': 'Name'},
-                orientation='h')
+    title2 = f'Codes Distribution [Variable Name (SNOMED term)] <Zoom {n_show} out of {n_terms} terms; zoom out to see all>'
+    if light:
+        # One trace per span would give hundreds of traces, only the most frequent spans get their own
+        fig2 = bar_chart(df_found.drop_duplicates(subset=["ID", "span", "count_ID"]).sort_values(by="count_ID", ascending=True),
+                         y='ID+term', x='count', color='span', title=title2, labels={'count': 'count', 'ID+term': 'Name'},
+                         max_traces=config.FIGURE_MAX_TRACES)
+    else:
+        fig2 = px.bar(df_found.drop_duplicates(subset=["ID", "span", "count_ID"]).sort_values(by="count_ID", ascending=True),
+                    y='ID+term', x='count', color='span', title=title2,
+                    labels={'count_total': 'Count', 'ID+term': 'Name'},
+                    orientation='h')
     
     # print(df_found.sort_values(by="count_ID", ascending=True).head().to_markdown())
     # print(df_found[df_found["name"] == "Losartan"].to_markdown())
@@ -194,6 +281,10 @@ def plot_code_distribution(df, corpus, show=True):
     df_report["mentions"] = df_report["count_ID"].sum()
     df_report["ratio"] = df_report["count_ID"]/df_report["count_ID"].sum()
     df_report.fillna(0, inplace=True)
+    # Levels between the variable and its nearest matched code (0 for its own code), empty when not found
+    distance = df[df["found"]].groupby(["ID", "label_corpus"])["distance"].min()
+    df_report.insert(df_report.columns.get_loc("count_ID") + 1, "distance",
+                     pd.Series(list(zip(df_report["ID"], df_report["label_corpus"])), index=df_report.index).map(distance))
 
     if show:
         fig_top.show()
@@ -205,3 +296,31 @@ def plot_code_distribution(df, corpus, show=True):
     return df_report, fig_top, fig0, fig1, fig2 #, figtab
 
 
+
+
+def bar_chart(df, y, x, color, title, labels, max_traces=None):
+    """
+    Horizontal stacked bar chart equivalent to px.bar(df, y=y, x=x, color=color, orientation='h'),
+    built directly from graph objects. With max_traces, only the colors with the highest total x
+    get their own trace and the rest are summed into a single "other" trace.
+    """
+    df = df[[y, x, color]]
+    ls_categories = df[y].drop_duplicates().tolist()
+
+    if max_traces is not None and df[color].nunique() > max_traces:
+        ls_top = df.groupby(color)[x].sum().nlargest(max_traces - 1).index
+        df_other = df[~df[color].isin(ls_top)].groupby(y, sort=False)[x].sum().reset_index()
+        df = pd.concat([df[df[color].isin(ls_top)], df_other.assign(**{color: "other"})])
+
+    # Traces and categories follow the order of the input rows, as with plotly express. The color
+    # value (e.g. a span) is passed as the trace meta, escaped, so that it is never read as
+    # template or HTML syntax
+    fig = go.Figure()
+    hovertemplate = f"{color}=%{{meta}}<br>{labels.get(x, x)}=%{{x}}<br>{labels.get(y, y)}=%{{y}}<extra></extra>"
+    for value, df_color in df.groupby(color, sort=False):
+        fig.add_trace(go.Bar(y=df_color[y].to_numpy(), x=df_color[x].to_numpy(), name=str(value), orientation='h',
+                             legendgroup=str(value), meta=html.escape(str(value)), hovertemplate=hovertemplate))
+    fig.update_layout(title=title, barmode='relative', legend_title_text=color,
+                      xaxis_title=labels.get(x, x), yaxis_title=labels.get(y, y),
+                      yaxis=dict(categoryorder="array", categoryarray=ls_categories))
+    return fig
@@ -0,0 +1,55 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class CodeVocabulary:
+    """
+    Maps code strings (SNOMED CT ids, composites, NO_CODE...) to dense int32 ids.
+
+    Ids are assigned in order of appearance and never change, so integer columns encoded
+    with the same vocabulary can be joined directly. Strings are only needed again when
+    results are displayed, through decode().
+    """
+
+    def __init__(self, codes=()):
+        self._index = pd.Index(pd.unique(np.asarray(codes, dtype=object)), dtype=object)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def encode(self, codes, add=True):
+        """
+        Return the int32 ids of codes. Unknown codes are added to the vocabulary, or mapped
+        to -1 when add is False.
+        """
+        if isinstance(getattr(codes, "dtype", None), pd.CategoricalDtype):
+            # Encode each category once and broadcast through the category codes
+            category_ids = self.encode(codes.cat.categories, add=add)
+            cat_codes = codes.cat.codes.to_numpy()
+            return np.where(cat_codes >= 0, category_ids[cat_codes], -1).astype(np.int32)
+
+        codes = np.asarray(codes, dtype=object)
+        ids = self._index.get_indexer(codes)
+        if add and (ids < 0).any():
+            with self._lock:
+                ids = self._index.get_indexer(codes)
+                new_codes = pd.unique(codes[ids < 0])
+                if len(new_codes):
+                    self._index = self._index.append(pd.Index(new_codes, dtype=object))
+                    ids = self._index.get_indexer(codes)
+        return ids.astype(np.int32)
+
+    def decode(self, ids):
+        """Return the code strings of ids (an object array)."""
+        return self._index.values[np.asarray(ids, dtype=np.int64)]
+
+    @property
+    def codes(self):
+        return self._index.values
+
+
+# Vocabulary shared by the corpora, variables and parents tables of the process
+VOCAB = CodeVocabulary()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tests import the app modules as src.* and read the data folders from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,157 @@
+"""
+Regression tests of the vectorized process_composites and generate_df_codes against the
+original row-wise implementations, kept below as they were before the rewrite.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.loader as loader
+from src.preprocessing import generate_df_codes, process_composites
+
+CORPORA = ["total", "distemist", "symptemist", "medprocner", "pharmaconer"]
+PROJECTS = ["DT4H", "CHAGAS", "BARITONE"]
+
+# Columns of the original generate_df_codes output
+CODES_COLUMNS = ["ID", "name", "code", "span", "term", "semantic_rel", "label", "label_corpus", "count", "found", "count_ID"]
+
+
+def legacy_process_composites(df, df_vars):
+    df_data = df.copy()
+    df_vars = df_vars.copy()
+
+    ls_var_codes = df_vars["code"].drop_duplicates().tolist()
+
+    df_data_comp = df_data[df_data["semantic_rel"] == "COMPOSITE"].copy()
+    df_data_comp["code_list"] = df_data_comp["code"].str.split("+")
+    df_data_comp["var_code"] = df_data_comp["code_list"].apply(lambda code: [c for c in code if c in ls_var_codes][0] if any(c in ls_var_codes for c in code) else code[0])
+    df_data_comp["var_code"] = df_data_comp["var_code"].astype(str)
+    df_data_comp.code = df_data_comp.var_code
+
+    df_data_no_comp = df_data[df_data["semantic_rel"] != "COMPOSITE"].copy()
+
+    return pd.concat([df_data_no_comp, df_data_comp], ignore_index=True)
+
+
+def legacy_generate_df_codes(df_data, df_vars):
+    """generate_df_codes without parents, which is the part of it that did not change behaviour."""
+    df_data = legacy_process_composites(df_data, df_vars)
+    df_data.rename(columns={"label": "label_corpus"}, inplace=True)
+
+    df_code_ovr = df_vars[["ID", "name", "code", "term", "label"]].merge(
+        df_data[['code', 'span', 'semantic_rel', "label_corpus"]].reset_index(), on='code', how='left').fillna("NOT_FOUND")
+    df_code_ovr = df_code_ovr.groupby(['ID', 'name', 'code', 'span', 'term', 'semantic_rel', 'label', 'label_corpus'])\
+                             .size().reset_index(name='count').sort_values(by="count", ascending=False)
+    df_code_ovr.loc[df_code_ovr.span == "NOT_FOUND", "count"] = 0
+    df_code_ovr["found"] = df_code_ovr["span"] != "NOT_FOUND"
+
+    df_count_group = df_code_ovr.groupby(["ID"]).aggregate({"count": "sum"}).reset_index()
+    df_code_ovr = df_code_ovr.merge(df_count_group, on="ID", suffixes=('', '_ID'))
+
+    df_code_rel = df_code_ovr.groupby(["ID", "semantic_rel"]).aggregate({"count": "sum"}).reset_index()
+    df_code_rel = df_code_rel.pivot(index="ID", columns="semantic_rel", values="count").fillna(0).reset_index()
+    return df_code_ovr.merge(df_code_rel, on="ID")
+
+
+def read_variables(project):
+    return pd.read_csv(loader.variables_path(project), sep='\t', dtype={'code': str})
+
+
+def read_corpus(corpus):
+    return pd.read_csv(f"{loader.DATA_FOLDER}/{corpus}.tsv", sep='\t', dtype={'code': str})
+
+
+def assert_same_rows(df_new, df_old, columns):
+    """Same rows in any order, the outputs are sorted by count with ties in no particular order."""
+    df_new = df_new[columns].astype({col: object for col in columns}).sort_values(columns).reset_index(drop=True)
+    df_old = df_old[columns].astype({col: object for col in columns}).sort_values(columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_new, df_old, check_dtype=False)
+
+
+def composite_cases():
+    """Mentions with composites of several parts, without variable parts, with | and without relation."""
+    df_vars = pd.DataFrame({"ID": ["V1", "V2", "V3"], "name": ["one", "two", "three"], "code": ["111", "222", "333"],
+                            "term": ["t1", "t2", "t3"], "label": ["L", "L", "L"]})
+    df_data = pd.DataFrame({
+        "label": ["ENFERMEDAD"] * 9,
+        "span": ["a", "b", "c", "d", "e", "f", "g", "h", "i"],
+        "code": ["900+222", "222+111", "900+901", "111|222", "222", "900+333+111", "333+", "111", "222+900"],
+        "semantic_rel": ["COMPOSITE", "COMPOSITE", "COMPOSITE", "COMPOSITE", np.nan, "COMPOSITE", "COMPOSITE", "EXACT",
+                         np.nan],
+    })
+    return df_data, df_vars
+
+
+@pytest.mark.parametrize("corpus", CORPORA)
+def test_process_composites_corpora(corpus):
+    df_data, df_vars = read_corpus(corpus), read_variables("DT4H")
+    df_new = process_composites(df_data, df_vars)
+    df_old = legacy_process_composites(df_data, df_vars)
+    pd.testing.assert_frame_equal(df_new.reset_index(drop=True), df_old[df_data.columns])
+
+
+def test_process_composites_cases():
+    df_data, df_vars = composite_cases()
+    df_new = process_composites(df_data, df_vars)
+    df_old = legacy_process_composites(df_data, df_vars)
+    pd.testing.assert_frame_equal(df_new.reset_index(drop=True), df_old[df_data.columns])
+    # The first part that is a variable, the first part otherwise; | is not a separator
+    assert dict(zip(df_new["span"], df_new["code"])) == {"a": "222", "b": "222", "c": "900", "d": "111|222", "e": "222",
+                                                         "f": "333", "g": "333", "h": "111", "i": "222+900"}
+
+
+def test_process_composites_does_not_modify_inputs():
+    df_data, df_vars = composite_cases()
+    df_data_before, df_vars_before = df_data.copy(), df_vars.copy()
+    process_composites(df_data, df_vars)
+    pd.testing.assert_frame_equal(df_data, df_data_before)
+    pd.testing.assert_frame_equal(df_vars, df_vars_before)
+
+
+@pytest.mark.parametrize("project", PROJECTS)
+@pytest.mark.parametrize("corpus", CORPORA)
+def test_generate_df_codes_corpora(project, corpus):
+    df_data, df_vars = read_corpus(corpus), read_variables(project)
+    df_old = legacy_generate_df_codes(df_data, df_vars)
+    columns = CODES_COLUMNS + [col for col in df_old.columns if col not in CODES_COLUMNS]
+
+    assert_same_rows(generate_df_codes(df_data, df_vars, n_parents=0), df_old, columns)
+    # Same output from the categorical columns of the loader and from the mention counts
+    assert_same_rows(generate_df_codes(loader.read_corpus_file(f"{loader.DATA_FOLDER}/{corpus}.tsv"), df_vars, n_parents=0),
+                     df_old, columns)
+    assert_same_rows(generate_df_codes(loader.count_corpus_file(f"{loader.DATA_FOLDER}/{corpus}.tsv"), df_vars, n_parents=0),
+                     df_old, columns)
+
+
+def test_generate_df_codes_cases():
+    df_data, df_vars = composite_cases()
+    df_old = legacy_generate_df_codes(df_data, df_vars)
+    columns = CODES_COLUMNS + [col for col in df_old.columns if col not in CODES_COLUMNS]
+    assert_same_rows(generate_df_codes(df_data, df_vars, n_parents=0), df_old, columns)
+
+
+@pytest.mark.parametrize("corpus", ["total", "distemist"])
+def test_count_corpus_file_chunks(corpus, monkeypatch):
+    path = f"{loader.DATA_FOLDER}/{corpus}.tsv"
+    df_expected = loader.count_corpus_file(path)
+    # The counts of each chunk are added to the running counts
+    monkeypatch.setattr(loader.config, "READ_CHUNK_SIZE", 1000)
+    columns = list(df_expected.columns)
+    assert_same_rows(loader.count_corpus_file(path), df_expected, columns)
+
+
+@pytest.mark.parametrize("n_parents", [2, -1])
+def test_deeper_parents_need_the_ancestor_table(n_parents, tmp_path, monkeypatch):
+    # The parent lists of a {n}_parents corpus give no depth, only 1 parent is read from them
+    df_data = read_corpus("1_parents/distemist")
+    with pytest.raises(ValueError):
+        generate_df_codes(df_data, read_variables("DT4H"), n_parents=n_parents)
+
+    monkeypatch.setattr(loader, "DATA_FOLDER", str(tmp_path))
+    os.makedirs(tmp_path / loader.parents_folder(n_parents))
+    df_data.to_csv(tmp_path / loader.parents_folder(n_parents) / "distemist.tsv", sep="\t", index=False)
+    assert loader.parents_path("distemist", n_parents) == loader.ancestors_path("distemist")
+    assert not os.path.exists(loader.parents_path("distemist", n_parents))
+    assert loader.parents_path("distemist", 1) == loader.corpus_path("distemist", 1)
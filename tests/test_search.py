@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from src.search import TrigramIndex
+
+TEXTS = ["insuficiencia cardiaca", "Insuficiencia cardíaca congestiva", "fiebre", "fiebre reumática", "cardiopatía",
+         "hipertensión arterial", "hipertension", "dolor torácico", "dolor abdominal", "fibrilación auricular"]
+QUERIES = ["insuficiencia cardiaca", "fiebre", "hipertension arterial", "dolor", "xyz", "", "fibrilacion"]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 10])
+@pytest.mark.parametrize("masked", [False, True])
+def test_search_many_matches_search(limit, masked):
+    index = TrigramIndex(TEXTS)
+    mask = np.arange(len(TEXTS)) % 3 != 0 if masked else None
+    # A small chunk size so that the queries are split across several chunks
+    query_ids, doc_ids, scores = index.search_many(QUERIES, limit=limit, mask=mask, chunk_size=3)
+    for i, query in enumerate(QUERIES):
+        expected_ids, expected_scores = index.search(query, limit=limit, mask=mask)
+        np.testing.assert_array_equal(doc_ids[query_ids == i], expected_ids)
+        np.testing.assert_array_equal(scores[query_ids == i], expected_scores)
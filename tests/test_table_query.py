@@ -0,0 +1,96 @@
+import json
+
+import pandas as pd
+import pytest
+
+from src.table_query import filter_frame, filter_records, query_page, query_records, split_filter_part
+
+
+@pytest.mark.parametrize("filter_part, expected", [
+    ('{name} contains "bone marrow"', ("name", "contains", "bone marrow")),
+    ('{name} contains "Large cell"', ("name", "contains", "Large cell")),
+    ('{name} contains "adult onset"', ("name", "contains", "adult onset")),
+    ("{name} contains 'Hypertension'", ("name", "contains", "Hypertension")),
+    ("{name} contains gene", ("name", "contains", "gene")),
+    ("{term} eq Not equal", ("term", "eq", "Not equal")),
+    ("{label} ne lt ", ("label", "ne", "lt")),
+    ("{count_ID_total} >= 5", ("count_ID_total", "ge", 5.0)),
+    ("{count_ID_total} ge 5", ("count_ID_total", "ge", 5.0)),
+    ("{count_ID_total} < 2.5", ("count_ID_total", "lt", 2.5)),
+    ("{count_ID_total} != 0", ("count_ID_total", "ne", 0.0)),
+    ("{count_ID_total} = 3", ("count_ID_total", "eq", 3.0)),
+    ("{ID} datestartswith DT4H", ("ID", "datestartswith", "DT4H")),
+    ("{name} icontains marrow", ("name", "icontains", "marrow")),
+    ("{name} scontains Marrow", ("name", "scontains", "Marrow")),
+    ("{name} ieq anemia", ("name", "ieq", "anemia")),
+    ("{count} ine 3", ("count", "ine", 3.0)),
+    ("{name} is blank", (None, None, None)),
+    ("name contains marrow", (None, None, None)),
+])
+def test_split_filter_part(filter_part, expected):
+    assert split_filter_part(filter_part) == expected
+
+
+@pytest.fixture
+def df_table():
+    return pd.DataFrame({
+        "ID": ["V1", "V2", "V3", "V4", "V5"],
+        "name": ["Bone marrow transplant", "Large cell carcinoma", "Adult onset diabetes", "Hypertension", "Anemia"],
+        "count": [3.0, 0.0, 12.0, None, 7.0],
+    })
+
+
+@pytest.mark.parametrize("filter_query, ids", [
+    ('{name} contains "bone marrow"', []),
+    ('{name} contains "Bone marrow"', ["V1"]),
+    ('{name} contains "Large cell"', ["V2"]),
+    ('{name} contains "adult onset"', []),
+    ('{name} contains "Adult onset"', ["V3"]),
+    ("{count} >= 3", ["V1", "V3", "V5"]),
+    ("{count} ne 3", ["V2", "V3", "V4", "V5"]),
+    ('{count} > 1 && {name} contains "a"', ["V1", "V3", "V5"]),
+    ("{ID} datestartswith V", ["V1", "V2", "V3", "V4", "V5"]),
+    ("{missing} = 1", ["V1", "V2", "V3", "V4", "V5"]),
+    ('{name} icontains "bone marrow"', ["V1"]),
+    ('{name} scontains "bone marrow"', []),
+    ("{name} ieq anemia", ["V5"]),
+    ("{name} eq anemia", []),
+    ("{name} ine anemia", ["V1", "V2", "V3", "V4"]),
+    ("{ID} idatestartswith v", ["V1", "V2", "V3", "V4", "V5"]),
+    # Text values on a numeric column match no number
+    ("{count} > abc", []),
+    ("{count} = foo", []),
+    ("{count} ne foo", ["V1", "V2", "V3", "V4", "V5"]),
+    # Numbers are compared as text as the table shows them, 12.0 as 12
+    ("{count} contains 1", ["V3"]),
+    ('{count} contains "3.0"', []),
+    ("{count} contains 7", ["V5"]),
+])
+def test_filter(df_table, filter_query, ids):
+    assert filter_frame(df_table, filter_query)["ID"].tolist() == ids
+    records = json.loads(df_table.to_json(orient="records"))
+    assert [record["ID"] for record in filter_records(records, filter_query, numeric_columns={"count"})] == ids
+
+
+@pytest.mark.parametrize("sort_by", [
+    [],
+    [{"column_id": "count", "direction": "desc"}],
+    [{"column_id": "count", "direction": "asc"}, {"column_id": "name", "direction": "desc"}],
+])
+def test_query_records_matches_query_page(df_table, sort_by):
+    records = json.loads(df_table.to_json(orient="records"))
+    for page_current in range(3):
+        page, page_count = query_page(df_table, "{count} != 12", sort_by, page_current, 2)
+        records_page, records_page_count = query_records(records, "{count} != 12", sort_by, page_current, 2,
+                                                         numeric_columns={"count"})
+        assert [record["ID"] for record in records_page] == [record["ID"] for record in page]
+        assert records_page_count == page_count
+
+
+@pytest.mark.parametrize("filter_query", ["{name} is blank", '{count} > 1 && {name} is nil'])
+def test_unsupported_filter(df_table, filter_query):
+    records = json.loads(df_table.to_json(orient="records"))
+    with pytest.raises(ValueError):
+        filter_frame(df_table, filter_query)
+    with pytest.raises(ValueError):
+        filter_records(records, filter_query, numeric_columns={"count"})
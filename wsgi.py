@@ -0,0 +1,12 @@
+import gc
+
+import src.loader as loader
+import src.search as search
+from app import server
+
+# Read the shared data once in the master process (gunicorn preload_app) before the workers
+# are forked, and keep the garbage collector from touching these objects afterwards so their
+# memory pages stay shared copy-on-write
+print(f"Preloaded {loader.preload()} dataframes")
+print(f"Indexed {len(search.load_search().spans)} corpus spans for search")
+gc.freeze()